@@ -9,6 +9,7 @@ import inquirer from 'inquirer';
 import jsdom from 'jsdom';
 import replace from 'replace-in-file';
 import { createRequire } from 'module';
+import { createInterface } from 'readline';
 import { exec, spawn, spawnSync } from 'child_process';
 import { join } from 'path';
 import { readJSON, remove } from 'fs-extra/esm';
@@ -115,7 +116,7 @@ export async function pythonSetup() {
   }
   spinner.succeed();
   ora(`Installing Ouvrai Python package in virtual environment`).info();
-  spawnSyncPython(venvPipCommand, ['install', '.']);
+  spawnSyncPython(venvPipCommand, ['install', '.[parquet]']);
 }
 
 export function spawnSyncPython(
@@ -158,6 +159,51 @@ export function spawnSyncPython(
   }
 }
 
+/**
+ * Run a Python command asynchronously while showing its progress on an ora spinner.
+ * Output lines starting with 'PROGRESS ' update the spinner text; other lines are printed as usual.
+ * @param {string} command Python executable
+ * @param {string[]} args Arguments to the Python executable
+ * @param {string} text Initial spinner text
+ * @returns {Promise<{status: number}>} Exit status of the Python process
+ */
+export function spawnPythonProgress(command, args, text) {
+  ora(`Spawning: ${command} ${args.join(' ')}`).info();
+  let pythonDir = new URL('../python', import.meta.url);
+  let spinner = ora(text).start();
+  return new Promise(function (resolve, reject) {
+    let subprocess = spawn(command, args, {
+      cwd: pythonDir,
+      shell: true,
+      stdio: ['inherit', 'pipe', 'inherit'],
+      windowsVerbatimArguments: true,
+    });
+    createInterface({ input: subprocess.stdout }).on('line', (line) => {
+      if (line.startsWith('PROGRESS ')) {
+        spinner.text = line.slice('PROGRESS '.length);
+      } else {
+        spinner.clear();
+        console.log(line);
+        spinner.render();
+      }
+    });
+    subprocess.on('error', (err) => {
+      spinner.fail();
+      reject(err);
+    });
+    subprocess.on('close', (code) => {
+      if (code === 0) {
+        spinner.succeed(
+          `Python command '${command} ${args.join(' ')}' was successful`
+        );
+      } else {
+        spinner.fail(`Spawn exited with code ${code}`);
+      }
+      resolve({ status: code });
+    });
+  });
+}
+
 /*********
  * Prolific Utilities */
 
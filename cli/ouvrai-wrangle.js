@@ -1,9 +1,9 @@
-import { Argument, Command } from 'commander';
+import { Argument, Command, Option } from 'commander';
 import { fileURLToPath, URL } from 'url';
 import ora from 'ora';
 import inquirer from 'inquirer';
 import { readdir } from 'fs/promises';
-import { exists, spawnSyncPython } from './cli-utils.js';
+import { exists, spawnPythonProgress } from './cli-utils.js';
 import { basename, extname, join } from 'path';
 import filenamify from 'filenamify';
 
@@ -12,10 +12,44 @@ const program = new Command()
   .argument('<studyname>', 'Name of study')
   .addArgument(
     new Argument('[format]', 'Output file format')
-      .choices(['pkl', 'csv', 'xlsx'])
+      .choices(['pkl', 'csv', 'xlsx', 'parquet', 'feather'])
       .default('pkl')
   )
   .option('-f, --filename [filename]', 'Specify output file name')
+  .option(
+    '-w, --workers <n>',
+    'Number of parallel processes for reading data files',
+    '1'
+  )
+  .option(
+    '--no-cache',
+    'Process all subjects again instead of reusing those that are unchanged since the last wrangle'
+  )
+  .addOption(
+    new Option(
+      '-d, --dtypes <policy>',
+      'Store compact data types to reduce memory and file size'
+    ).choices(['compact', 'compact_float32'])
+  )
+  .option('-p, --profile', 'Report time used by each stage and peak memory of the process')
+  .addOption(
+    new Option(
+      '--frame-format <format>',
+      'Save the frame table in a different format, e.g. parquet when [format] is xlsx'
+    ).choices(['pkl', 'csv', 'parquet', 'feather'])
+  )
+  .option(
+    '--studies <studynames...>',
+    "Combine data from other studies with <studyname>, adding a 'study' column (saved in the folder of <studyname>)"
+  )
+  .option(
+    '--worker',
+    'Keep Python and recently wrangled tables in memory in a background process, making later calls faster'
+  )
+  .option(
+    '--watch [seconds]',
+    'Keep the output files up to date as new data files are downloaded, checking every [seconds] (default 10)'
+  )
   .showHelpAfterError()
   .parse();
 
@@ -25,7 +59,11 @@ let filename = 'df';
 let options = program.opts();
 if (options.filename) {
   let extension = extname(options.filename);
-  if (['.pkl', '.csv', '.txt', '.xlsx', '.xls'].includes(extension)) {
+  if (
+    ['.pkl', '.csv', '.txt', '.xlsx', '.xls', '.parquet', '.feather'].includes(
+      extension
+    )
+  ) {
     format = extension.slice(1); // drop the .
     filename = filenamify(basename(options.filename, format));
   } else {
@@ -47,7 +85,10 @@ dataPath = `'${dataPath}'`; // Must use single quotes for Windows (no idea why)
 // UI to select files you want
 let jsonFiles = await readdir(dataURL);
 jsonFiles = jsonFiles.filter((fn) => fn.endsWith('.json'));
-if (jsonFiles.length > 1) {
+if (options.watch || options.studies) {
+  // Wrangle all data files, including those downloaded later (see ouvrai-download.js)
+  jsonFiles = ['^data_.*\\.json$'];
+} else if (jsonFiles.length > 1) {
   let answers = await inquirer.prompt([
     {
       name: 'filesToWrangle',
@@ -79,13 +120,39 @@ if (await exists(venvPythonPathUnix)) {
   throw new Error('Failed to find Python virtual environment for Ouvrai');
 }
 
-let subp = spawnSyncPython(venvPythonCommand, [
-  'wrangle.py',
-  dataPath,
-  format,
-  fileRegex,
-  filename,
-]);
+let subp = await spawnPythonProgress(
+  venvPythonCommand,
+  [
+    'wrangle.py',
+    dataPath,
+    format,
+    fileRegex,
+    filename,
+    '--workers',
+    options.workers,
+    ...(options.cache ? ['--cache'] : []),
+    ...(options.dtypes ? ['--dtypes', options.dtypes] : []),
+    ...(options.profile ? ['--profile'] : []),
+    ...(options.frameFormat ? ['--frame-format', options.frameFormat] : []),
+    ...(options.worker ? ['--worker'] : []),
+    ...(options.studies
+      ? [
+          '--studies',
+          ...[studyName, ...options.studies].map(
+            (name) =>
+              `'${fileURLToPath(
+                new URL(`../experiments/${name}/analysis/`, import.meta.url)
+              )}'`
+          ),
+        ]
+      : []),
+    ...(options.watch
+      ? ['--watch', '--interval', options.watch === true ? '10' : options.watch]
+      : []),
+    '--progress',
+  ],
+  'Wrangling data'
+);
 if (subp.status === 1) {
   ora(
     `Failed to wrangle JSON files. Did you successfully install the Python utilities during ouvrai setup?`
@@ -0,0 +1,144 @@
+"""
+Time and peak memory of each stage of the wrangling pipeline on synthetic data, at several scales.
+Usage (from the python folder, with ouvrai installed): python benchmarks/benchmark.py small medium 20x100x120 -o benchmarks.csv
+"""
+
+import os, io, time, argparse, tempfile, contextlib, tracemalloc, warnings
+import pandas as pd
+import ouvrai as ou
+from synthetic import write_export
+
+# subjects x trials x frames per trial
+SCALES = {
+    "small": (10, 50, 100),
+    "medium": (40, 200, 120),
+    "large": (100, 400, 150),
+}
+
+
+def run_pipeline(data_folder: str, workers: int = 1, measure=None):
+    """
+    Run each stage of the wrangling pipeline on the data in `data_folder`.
+
+    Parameters
+    ----------
+    data_folder : str
+        Folder containing data_*.json files
+    workers : int, optional
+        Number of processes used by `load`, by default 1
+    measure : function, optional
+        Called as `measure(stage, function, *args)` to run each stage, by default the stages just run
+
+    Returns
+    -------
+    dict
+        Number of frames and trials
+    """
+    measure = measure or (lambda stage, f, *args: f(*args))
+    data_folder = os.path.join(data_folder, "")
+    with contextlib.redirect_stdout(io.StringIO()):  # silence progress messages
+        df_trial, df_subject, df_frame, df_state = measure(
+            "load",
+            lambda: ou.load(data_folder=data_folder, save_format=None, workers=workers),
+        )
+    df_kin = measure("compute_kinematics", ou.compute_kinematics, df_subject, df_frame)
+    measure("smooth_kinematics", ou.smooth_kinematics, df_kin)
+    df_trial, df_kin = measure(
+        "find_first_velocity_peak",
+        ou.find_first_velocity_peak,
+        df_trial,
+        df_subject,
+        df_kin,
+    )
+    measure(
+        "euler_to_direction",
+        lambda: ou.euler_to_direction(data=df_frame, prefix="rhOri"),
+    )
+    return {"frames": len(df_frame), "trials": len(df_trial)}
+
+
+def benchmark(data_folder: str, workers: int = 1, repeat: int = 3, memory: bool = True):
+    """
+    Time each stage of the pipeline (best of `repeat` runs) and measure its peak memory with tracemalloc (in a separate run, since tracing slows Python down).
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per stage with columns 'seconds' and 'peak_mb'
+    """
+    results = {}
+
+    def timed(stage, f, *args):
+        tic = time.perf_counter()
+        out = f(*args)
+        seconds = time.perf_counter() - tic
+        results.setdefault(stage, {"seconds": seconds})
+        results[stage]["seconds"] = min(results[stage]["seconds"], seconds)
+        return out
+
+    def traced(stage, f, *args):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        out = f(*args)
+        results[stage]["peak_mb"] = (tracemalloc.get_traced_memory()[1] - start) / 1e6
+        return out
+
+    for _ in range(repeat):
+        size = run_pipeline(data_folder, workers, timed)
+    if memory:
+        tracemalloc.start()
+        run_pipeline(data_folder, workers, traced)
+        tracemalloc.stop()
+    df = pd.DataFrame.from_dict(results, orient="index")
+    df.index.name = "stage"
+    return df.assign(**size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Ouvrai wrangling pipeline on synthetic data."
+    )
+    parser.add_argument(
+        "scales",
+        nargs="*",
+        default=["small", "medium"],
+        help=f"Presets {list(SCALES)} or SUBJECTSxTRIALSxFRAMES, e.g. 20x100x120",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc")
+    parser.add_argument("--vector3", nargs="+", default=["rhPos"])
+    parser.add_argument("--quaternions", nargs="+", default=["rhOri"])
+    parser.add_argument("-o", "--output", help="Append results to this .csv file")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    tables = []
+    for scale in args.scales:
+        subjects, trials, frames = SCALES.get(scale) or map(int, scale.split("x"))
+        with tempfile.TemporaryDirectory() as data_folder:
+            write_export(
+                data_folder,
+                subjects,
+                trials,
+                frames,
+                vector3=args.vector3,
+                quaternions=args.quaternions,
+            )
+            mb = sum(
+                os.path.getsize(os.path.join(data_folder, fn))
+                for fn in os.listdir(data_folder)
+            )
+            df = benchmark(data_folder, args.workers, args.repeat, not args.no_memory)
+        df = df.assign(scale=f"{subjects}x{trials}x{frames}", json_mb=mb / 1e6)
+        print(df.round(3).to_string(), "\n")
+        tables.append(df.reset_index())
+
+    if args.output:
+        df = pd.concat(tables).assign(
+            timestamp=pd.Timestamp.now().strftime("%Y%m%d_%H%M%S"),
+            workers=args.workers,
+        )
+        df.to_csv(
+            args.output, mode="a", index=False, header=not os.path.exists(args.output)
+        )
@@ -0,0 +1,194 @@
+"""
+Synthetic Firebase exports for benchmarking.
+Usage: python benchmarks/synthetic.py <data_folder> --subjects 20 --trials 100 --frames 120
+"""
+
+import os, json, string, argparse
+import numpy as np
+
+STATE_NAMES = [
+    "CONSENT",
+    "SIGNIN",
+    "SETUP",
+    "START",
+    "DELAY",
+    "GO",
+    "MOVING",
+    "RETURN",
+    "FINISH",
+]
+TRIAL_STATES = ["START", "DELAY", "GO", "MOVING", "RETURN"]
+
+
+def write_export(
+    data_folder: str = "./",
+    subjects: int = 20,
+    trials: int = 100,
+    frames: int = 120,
+    vector3: list = ["rhPos"],
+    quaternions: list = ["rhOri"],
+    files: int = 1,
+    seed: int = 0,
+):
+    """
+    Write synthetic Firebase exports (data_*.json) with the same shape as real Ouvrai data, i.e. {UID: {"info": {...}, trialNumber: {...}}}.
+    Each trial is a reach from the home position to a target at 'targetDistance' with a minimum-jerk profile.
+    Position and orientation variables are recorded on every frame, and state changes are recorded with head pose.
+
+    Parameters
+    ----------
+    data_folder : str, optional
+        Folder where the files are written, by default "./"
+    subjects : int, optional
+        Number of subjects, by default 20
+    trials : int, optional
+        Number of trials per subject, by default 100
+    frames : int, optional
+        Average number of frames per trial (90 Hz), by default 120
+    vector3 : list, optional
+        Names of position variables (Vector3), by default ["rhPos"]. The first one moves to the target.
+    quaternions : list, optional
+        Names of orientation variables (Quaternion), by default ["rhOri"]
+    files : int, optional
+        Number of files (subjects are split evenly across files), by default 1
+    seed : int, optional
+        Random seed, by default 0
+
+    Returns
+    -------
+    list
+        Paths of the files
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_folder, exist_ok=True)
+    alphabet = np.array(list(string.ascii_letters + string.digits))
+    uids = ["".join(rng.choice(alphabet, 28)) for _ in range(subjects)]
+    paths = []
+    for fi, chunk in enumerate(np.array_split(np.arange(subjects), files)):
+        path = os.path.join(data_folder, f"data_20240101_{fi:06d}.json")
+        # Write one subject at a time to keep memory low for large exports
+        with open(path, "w") as f:
+            f.write("{")
+            for i, si in enumerate(chunk):
+                subject = _subject(rng, trials, frames, vector3, quaternions)
+                f.write(("," if i > 0 else "") + json.dumps(uids[si]) + ":")
+                json.dump(subject, f)
+            f.write("}")
+        paths.append(path)
+    return paths
+
+
+def _subject(rng, trials: int, frames: int, vector3: list, quaternions: list):
+    """Synthetic data of one subject."""
+    home = {"x": 0.0, "y": round(rng.uniform(0.8, 1.1), 3), "z": -0.3}
+    target_distance = 0.2
+    info = {
+        "requireVR": True,
+        "targetDistance": target_distance,
+        "homePosn": home,
+        "targetIds": [0, 1, 2, 3, 4, 5, 6],
+        "restTrials": -9999,  # empty arrays are replaced with -9999
+        "stateNames": STATE_NAMES,
+        "workerId": "".join(
+            rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"), 13)
+        ),
+        "completed": True,
+        "trialNumber": "info",
+    }
+    subject = {"info": info}
+    t = rng.uniform(1e4, 1e5)
+    for tn in range(trials):
+        subject[str(tn)] = _trial(
+            rng, tn, t, frames, home, target_distance, vector3, quaternions
+        )
+        t += rng.uniform(2000, 4000)
+    return subject
+
+
+def _trial(rng, tn, t0, frames, home, target_distance, vector3, quaternions):
+    """Synthetic data of one reaching trial."""
+    n = max(int(rng.normal(frames, frames / 10)), 10)
+    t = t0 + np.cumsum(rng.normal(1000 / 90, 0.5, n))
+    t[0] = np.round(t[0])  # mix of ints and floats, as in real data
+    # Minimum-jerk reach that starts after a random delay
+    onset = rng.uniform(0.2, 0.4) * n
+    duration = rng.uniform(0.3, 0.5) * n
+    s = np.clip((np.arange(n) - onset) / duration, 0, 1)
+    s = 10 * s**3 - 15 * s**4 + 6 * s**5
+    angle = rng.choice(np.linspace(-np.pi / 3, np.pi / 3, 7))
+    reach = target_distance * rng.uniform(0.9, 1.1)
+    x = home["x"] + reach * s * np.sin(angle)
+    z = home["z"] - reach * s * np.cos(angle)
+    y = np.full(n, home["y"])
+    # Tracking is not perfect
+    x, y, z = [v + rng.normal(0, 2e-4, n) for v in [x, y, z]]
+    still = rng.random(n) < 0.02  # repeated frames
+    still[0] = False
+    for v in [x, y, z]:
+        for i in np.flatnonzero(still):
+            v[i] = v[i - 1]
+
+    # State on each frame and state changes
+    bounds = np.array([0, onset * 0.5, onset, onset + duration * 0.1, onset + duration])
+    state_idx = np.searchsorted(bounds, np.arange(n), side="right") - 1
+    trial = {
+        "trialNumber": tn,
+        "cycle": tn // 7,
+        "targetId": int(tn % 7),
+        "block": {"name": "exp", "trial": tn},
+        "startTime": float(t[0]),
+        "targetPosn": {
+            "x": home["x"] + target_distance * float(np.sin(angle)),
+            "y": home["y"],
+            "z": home["z"] - target_distance * float(np.cos(angle)),
+        },
+        "t": [int(t[0])] + t[1:].tolist(),
+        "state": [TRIAL_STATES[i] for i in state_idx],
+    }
+    for vi, name in enumerate(vector3):
+        offset = 0.1 * vi
+        trial[name] = [{"x": a + offset, "y": b, "z": c} for a, b, c in zip(x, y, z)]
+    for name in quaternions:
+        # Rotation about the vertical axis that follows the reach direction
+        yaw = angle * s + rng.normal(0, 0.01, n)
+        trial[name] = [
+            {"_x": 0.0, "_y": a, "_z": 0.0, "_w": b, "isQuaternion": True}
+            for a, b in zip(np.sin(yaw / 2).tolist(), np.cos(yaw / 2).tolist())
+        ]
+    changes = np.flatnonzero(np.diff(state_idx, prepend=-1))
+    trial["stateChange"] = [TRIAL_STATES[state_idx[i]] for i in changes]
+    trial["stateChangeTime"] = [float(t[i]) for i in changes]
+    trial["stateChangeHeadPos"] = [
+        {"x": 0.0, "y": home["y"] + 0.6, "z": 0.0} for _ in changes
+    ]
+    trial["stateChangeHeadOri"] = [
+        {"_x": 0.0, "_y": 0.0, "_z": 0.0, "_order": "XYZ", "isEuler": True}
+        for _ in changes
+    ]
+    return trial
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write synthetic Firebase exports (data_*.json) for benchmarking."
+    )
+    parser.add_argument("data_folder")
+    parser.add_argument("-s", "--subjects", type=int, default=20)
+    parser.add_argument("-t", "--trials", type=int, default=100)
+    parser.add_argument("-f", "--frames", type=int, default=120)
+    parser.add_argument("--vector3", nargs="+", default=["rhPos"])
+    parser.add_argument("--quaternions", nargs="+", default=["rhOri"])
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    write_export(
+        data_folder=args.data_folder,
+        subjects=args.subjects,
+        trials=args.trials,
+        frames=args.frames,
+        vector3=args.vector3,
+        quaternions=args.quaternions,
+        files=args.files,
+        seed=args.seed,
+    )
@@ -1 +1,20 @@
-from .ouvrai import *
+# Import the ouvrai module (and pandas, numpy) only when one of its names is first used,
+# so that `import ouvrai` is fast, e.g. in wrangle.py when the work is done by a worker (see ouvrai.worker)
+import importlib
+
+
+def __getattr__(name):
+    if name in {"ouvrai", "worker"}:
+        return importlib.import_module(f".{name}", __name__)
+    module = importlib.import_module(".ouvrai", __name__)
+    if name == "__all__":
+        # same names as `from .ouvrai import *`
+        return [k for k in vars(module) if not k.startswith("_")]
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__getattr__("__all__")))
@@ -1,5 +1,7 @@
-import datetime
-import os, json, re, warnings, random
+import datetime, time
+import os, io, sys, json, re, warnings, contextlib, random, itertools, operator, codecs, mmap, hashlib, glob, tempfile, shutil, weakref
+import pickle as pkl
+import concurrent.futures
 import numpy as np
 import pandas as pd
 
@@ -15,6 +17,12 @@ def load(
     pickle: bool = False,
     save_format: str = "pkl",
     save_name: str = "df",
+    workers: int = 1,
+    cache: bool = False,
+    dtypes: str = None,
+    profile: bool = False,
+    progress=None,
+    frame_format: str = None,
 ):
     """
     Wrangle Firebase JSON data into data frames.
@@ -26,13 +34,33 @@ def load(
     file_regex : str, optional
         Regular expression uniquely identifying data files to load, by default "^data_"
     from_pkl : bool, optional
-        Load data frames from .pkl files (if they exist), by default False
+        Load data frames from the most recent .pkl files named with `save_name` (if they exist), by default False
     pickle : bool, optional
         Save data frames to .pkl files, by default False
     save_format : str, optional
-        Save data frames to other file types (if `pickle = False`), by default "pkl"
+        Save data frames to other file types (if `pickle = False`), by default "pkl". Use None to skip saving.
+        Options are "pkl", "csv", "xlsx", "parquet", and "feather". Parquet and Feather require the pyarrow package.
+        For Excel, tables with more rows than fit in a worksheet are split across numbered sheets, e.g. 'frame_1', 'frame_2', ... (see write_excel).
+        For Parquet and Feather, the frame and state tables are saved as folders with one file per subject (see load_table).
     save_name : str, optional
         Specify file name of the output data file (prefix if save_format = "pkl" or "csv")
+    workers : int, optional
+        Number of processes used to read and tabulate data files in parallel, by default 1. If None, use all CPU cores.
+        Large files are split into several parts. The results are the same for any number of workers.
+    cache : bool, optional
+        Cache each subject's tabulated data in `data_folder`/.ouvrai_cache, by default False.
+        Subjects are identified by a hash of their raw data, so only new or changed subjects are processed in later calls.
+        Cached subjects that were not used by the call (e.g., older versions of changed subjects) are deleted.
+    dtypes : str, optional
+        Data type policy, by default None (keep inferred types). Use "compact" to reduce memory (see compact_dtypes),
+        or "compact_float32" to also store frame and state variables (except 't') as 32-bit floats.
+    profile : bool, optional
+        Also return a LoadReport with the time used by each stage, the peak memory of the process at the end of each stage, and the number of subjects in each file, by default False
+    progress : function, optional
+        Called with a short description of the current stage whenever it changes (e.g., to update a progress spinner), by default None
+    frame_format : str, optional
+        Save the frame table in this format instead of `save_format`, by default None.
+        For example, use save_format = "xlsx" and frame_format = "parquet" to open the trial, subject, and state tables in Excel.
 
     Returns
     -------
@@ -47,173 +75,2132 @@ def load(
             Data frame where each row is a single render loop.
         df_state
             Data frame where each row is a state transition in the experiment finite-state machine.
+        report
+            LoadReport (only if `profile = True`)
     """
 
     # Strip any leading/trailing quotes added when running from command line (see ouvrai-wrangle.js)
     data_folder = data_folder.lstrip("'").rstrip("'")
+    report = LoadReport(progress)
 
     if from_pkl:
+        report.start("Reading .pkl files")
         try:
-            df_trial = pd.read_pickle(data_folder + "df_trial.pkl")
-            df_subject = pd.read_pickle(data_folder + "df_subject.pkl")
-            df_frame = pd.read_pickle(data_folder + "df_frame.pkl")
-            df_state = pd.read_pickle(data_folder + "df_state.pkl")
+            # Most recent outputs saved with the same save_name (see below)
+            df_trial, df_subject, df_frame, df_state = [
+                pd.read_pickle(_latest_output(data_folder, save_name, table, "pkl"))
+                for table in ["trial", "subject", "frame", "state"]
+            ]
         except:
             warnings.warn(
                 "Failed to load .pkl files. Did you mean to set from_pkl = False?"
             )
             return
     else:
-        # Collect data
-        dir_contents = os.listdir(data_folder)  # contents of the data folder
-        D = {}  # initalize dictionary D to store all the data
-        for filename in [fn for fn in dir_contents if re.search(file_regex, fn)]:
-            print(f"Reading {filename}")
-            with open(data_folder + filename) as open_file:  # prefix with data_folder
-                d = json.load(open_file)  # read into a small dictionary d
-                if not all([len(l) == 28 for l in d.keys()]):
-                    warnings.warn(
-                        "Keys do not look like Firebase UIDs! Check your files."
-                    )
-                D = {**D, **d}  # concatenate dictionaries
-
-        # Arrange it in a data frame
-        df_trial = pd.DataFrame()
-        df_subject = pd.DataFrame()
-        for si, (s, d) in enumerate(D.items()):  # loop over subjects
-            info = pd.json_normalize(d.pop("info"))  # separate out the 'info'
-            data = pd.DataFrame.from_dict(
-                d, orient="index"
-            )  # read dictionary as data frame
-            data["subject"] = "{:0>3}".format(si)
-            data["uid"] = s
-            info["subject"] = "{:0>3}".format(si)
-            info["uid"] = s
-            df_trial = pd.concat([df_trial, data], ignore_index=True)
-            df_subject = pd.concat([df_subject, info], ignore_index=True)
-
-        # Separate list-type columns containing frame data or state-change data
-        reftrial = df_trial.iloc[0]
-        reftrial = reftrial[reftrial.apply(isinstance, args=(list,))]
-        # Per-frame columns should be the same length as "t"
-        numframes_reftrial = len(reftrial["t"])
-        frame_columns = [
-            c for c in reftrial.index if len(reftrial[c]) == numframes_reftrial
-        ]
-        print(f"Frame variables are: {frame_columns}")
-        # Per-statechange columns should be the same length as "stateChange"
-        numstatechanges_reftrial = len(reftrial["stateChange"])
-        statechange_columns = [
-            c for c in reftrial.index if len(reftrial[c]) == numstatechanges_reftrial
-        ]
-        print(f"State change variables are: {statechange_columns}")
-        # Pop these columns from df_trial and reassemble them in their own DataFrames
-        df_frame = pd.concat([df_trial.pop(c) for c in frame_columns], axis=1)
-        df_state = pd.concat([df_trial.pop(c) for c in statechange_columns], axis=1)
-
-        # Add information that is missing from the new DataFrames
-        df_frame["subject"] = df_trial["subject"]
-        df_frame["trialNumber"] = df_trial["trialNumber"]
-        df_frame["cycle"] = df_trial["cycle"]
-        df_state["subject"] = df_trial["subject"]
-        df_state["trialNumber"] = df_trial["trialNumber"]
-
-        # Explode new DataFrames with per-trial lists into long format
-        df_frame = df_frame.explode(frame_columns, True)
-        df_state = df_state.explode(statechange_columns, True)
-
-        # Expand any object columns (typically x,y,z)
-        df_trial = expand_object_columns(df_trial)
-        df_subject = expand_object_columns(df_subject)
-        df_frame = expand_object_columns(df_frame)
-        df_state = expand_object_columns(df_state)
-
-        # [DEPRECATED] Transform "stateNames" into a dictionary mapping from integer codes to names
-        # df_subject["stateNames"] = df_subject["stateNames"].transform(
-        #     lambda x: {id: name for id, name in enumerate(x)}
-        # )
-        # df_frame["state"] = rename_states(df_frame, df_subject)
-        # df_state["state"] = rename_states(df_state, df_subject, state_col="stateChange")
-
-        # Sometimes t is dtype 'object' due to mix of ints and floats
-        df_frame["t"] = df_frame["t"].astype(float)
-
-        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        if pickle or save_format in {"pkl", ".pkl", "pickle"}:
-            df_trial.to_pickle(data_folder + save_name + "_trial_" + ts + ".pkl")
-            df_subject.to_pickle(data_folder + save_name + "_subject_" + ts + ".pkl")
-            df_frame.to_pickle(data_folder + save_name + "_frame_" + ts + ".pkl")
-            df_state.to_pickle(data_folder + save_name + "_state_" + ts + ".pkl")
-        elif save_format in {"csv", "txt", ".csv", ".txt"}:
-            df_trial.to_csv(data_folder + save_name + "_trial_" + ts + ".csv")
-            df_subject.to_csv(data_folder + save_name + "_subject_" + ts + ".csv")
-            df_frame.to_csv(data_folder + save_name + "_frame_" + ts + ".csv")
-            df_state.to_csv(data_folder + save_name + "_state_" + ts + ".csv")
-        elif save_format in {"xls", "xlsx", ".xls", ".xlsx", "excel"}:
-            with pd.ExcelWriter(data_folder + save_name + "_" + ts + ".xlsx") as writer:
-                df_trial.to_excel(writer, "trial")
-                df_subject.to_excel(writer, "subject")
-                df_frame.to_excel(writer, "frame")
-                df_state.to_excel(writer, "state")
+        df_trial, df_subject, df_frame, df_state, schema = _wrangle(
+            data_folder, file_regex, workers, cache, dtypes, report
+        )
+        _save_outputs(
+            {
+                "trial": df_trial,
+                "subject": df_subject,
+                "frame": df_frame,
+                "state": df_state,
+            },
+            schema,
+            data_folder,
+            save_name,
+            "pkl" if pickle else save_format,
+            frame_format,
+            report,
+        )
 
         df_frame.reset_index(drop=True, inplace=True)
 
+    report.finish(df_trial, df_subject, df_frame, df_state)
+    if profile:
+        return df_trial, df_subject, df_frame, df_state, report
+    return df_trial, df_subject, df_frame, df_state
+
+
+class LoadReport:
+    """
+    Time used by each stage of `load`, peak memory of the process at the end of each stage, and the size of each data file and of the resulting tables.
+    Returned by `load(..., profile=True)`. Print it for a summary, or use `to_frame()`.
+
+    Attributes
+    ----------
+    stages : list[dict]
+        Name, duration (seconds), and peak memory of the process so far (MB) of each stage.
+        The peak is a high-water mark since the process started, not the memory used by the stage: it only increases when a stage uses more memory than all earlier stages.
+    files : list[dict]
+        Name, size (MB), and number of subjects of each data file
+    counts : dict
+        Number of subjects, trials, frames, and state changes
+    """
+
+    def __init__(self, progress=None):
+        self.stages = []
+        self.files = []
+        self.counts = {}
+        self._progress = progress
+        self._stage = None
+        self._tic = None
+
+    def start(self, stage: str):
+        """End the current stage (if any) and start a new one."""
+        self._end()
+        self._stage = stage
+        self._tic = time.perf_counter()
+        if self._progress is not None:
+            self._progress(stage)
+
+    def step(self, done: int, total: int):
+        """Report progress within the current stage."""
+        if self._progress is not None:
+            self._progress(f"{self._stage} ({done}/{total})")
+
+    def add_file(self, path: str, subjects: int):
+        self.files.append(
+            {
+                "file": os.path.basename(path),
+                "mb": os.path.getsize(path) / 1e6,
+                "subjects": subjects,
+            }
+        )
+
+    def finish(self, df_trial, df_subject, df_frame, df_state):
+        """End the last stage and count the rows of the tables."""
+        self._end()
+        self.counts = {
+            "subjects": len(df_subject),
+            "trials": len(df_trial),
+            "frames": len(df_frame),
+            "state changes": len(df_state),
+        }
+
+    def _end(self):
+        if self._stage is not None:
+            self.stages.append(
+                {
+                    "stage": self._stage,
+                    "seconds": time.perf_counter() - self._tic,
+                    "process_peak_mb": _peak_memory(),
+                }
+            )
+            self._stage = None
+
+    def to_frame(self):
+        """Data frame with one row per stage."""
+        return pd.DataFrame(
+            self.stages, columns=["stage", "seconds", "process_peak_mb"]
+        )
+
+    def __str__(self):
+        lines = [self.to_frame().round(3).to_string(index=False)]
+        if len(self.files) > 0:
+            lines.append(pd.DataFrame(self.files).round(3).to_string(index=False))
+        lines.append(", ".join(f"{v} {k}" for k, v in self.counts.items()))
+        total = sum(x["seconds"] for x in self.stages)
+        lines.append(f"Total: {total:.3f} seconds")
+        return "\n\n".join(lines)
+
+
+def _peak_memory():
+    """Peak resident memory (MB) of this process and its (finished) worker processes, NaN if unavailable (e.g., on Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def load_studies(
+    studies,
+    file_regex: str = "^data_",
+    save_folder: str = "./",
+    save_format: str = "parquet",
+    save_name: str = "df",
+    workers: int = 1,
+    cache: bool = False,
+    dtypes: str = None,
+    profile: bool = False,
+    progress=None,
+):
+    """
+    Wrangle the Firebase JSON data of several studies (e.g., pilot, main, and replication) into combined data frames, with a categorical 'study' column.
+    Subjects are numbered across all studies, so subject codes do not collide.
+    A subject (Firebase UID) that appears in the exports of several studies is kept once, from the most recent export.
+
+    Parameters
+    ----------
+    studies : dict or list
+        Data folders by study name, e.g. {"pilot": "experiments/pilot/analysis/", "main": "experiments/main/analysis/"},
+        or a list of data folders, named after the study folder (i.e. experiments/<study>/analysis/)
+    file_regex : str, optional
+        Regular expression identifying data files in each folder, by default "^data_"
+    save_folder : str, optional
+        Folder where the combined data frames are saved, by default "./"
+    save_format : str, optional
+        Output file format (see load), by default "parquet" (frame and state tables with one file per subject)
+    save_name : str, optional
+        File name prefix of the outputs, by default "df"
+    workers : int, optional
+        Number of processes used to read the data files of all studies in parallel (see load), by default 1
+    cache : bool, optional
+        Cache each subject's tabulated data in `save_folder`/.ouvrai_cache (see load), by default False
+    dtypes : str, optional
+        Data type policy (see load), by default None
+    profile : bool, optional
+        Also return a LoadReport (see load), by default False
+    progress : function, optional
+        Called with a short description of the current stage (see load), by default None
+
+    Returns
+    -------
+    tuple
+        df_trial, df_subject, df_frame, df_state (and report if `profile = True`), as returned by load
+    """
+    if not isinstance(studies, dict):
+        studies = {_study_name(folder): folder for folder in studies}
+    names = list(studies)
+    if len(set(names)) < len(names):
+        raise ValueError(f"Study names must be unique: {names}")
+    save_folder = os.path.join(save_folder.lstrip("'").rstrip("'"), "")
+    report = LoadReport(progress)
+
+    # Oldest files first, so that the newest copy of a subject takes precedence
+    files = []
+    for si, folder in enumerate(studies.values()):
+        folder = os.path.join(folder.lstrip("'").rstrip("'"), "")
+        for fn in sorted(os.listdir(folder)):
+            if re.search(file_regex, fn):
+                files.append((_download_time(folder + fn), si, folder + fn))
+    files.sort()
+    study_of = {path: si for _, si, path in files}
+    cache_folder = os.path.join(save_folder, ".ouvrai_cache") if cache else None
+    sources = {}
+    subjects = _read_subjects(
+        [path for _, _, path in files], workers, cache_folder, report, sources
+    )
+    study = {uid: study_of[paths[-1]] for uid, paths in sources.items()}
+    duplicates = [
+        uid for uid, paths in sources.items() if len({study_of[p] for p in paths}) > 1
+    ]
+    if duplicates:
+        warnings.warn(
+            f"{len(duplicates)} subjects appear in several studies and were kept from the most recent export, e.g., {duplicates[0]}"
+        )
+    # Number subjects by study, then in order of appearance
+    subjects = dict(sorted(subjects.items(), key=lambda item: study[item[0]]))
+
+    df_trial, df_subject, df_frame, df_state, schema = _build_tables(subjects, report)
+    del subjects
+    df_trial, df_subject, df_frame, df_state = _apply_dtypes(
+        (df_trial, df_subject, df_frame, df_state), dtypes, report
+    )
+
+    # Add the study of each subject to every table
+    codes = np.array([study[uid] for uid in df_subject["uid"]], dtype=int)
+    tables = {
+        "trial": df_trial,
+        "subject": df_subject,
+        "frame": df_frame,
+        "state": df_state,
+    }
+    for df in tables.values():
+        sb = pd.Categorical(df["subject"], categories=df_subject["subject"]).codes
+        df.insert(0, "study", pd.Categorical.from_codes(codes[sb], categories=names))
+
+    _save_outputs(tables, schema, save_folder, save_name, save_format, None, report)
+    df_frame.reset_index(drop=True, inplace=True)
+    report.finish(df_trial, df_subject, df_frame, df_state)
+    if profile:
+        return df_trial, df_subject, df_frame, df_state, report
     return df_trial, df_subject, df_frame, df_state
 
 
+def _study_name(folder: str):
+    """Name of a study from its data folder, i.e. <study> in experiments/<study>/analysis/."""
+    parts = os.path.normpath(folder.lstrip("'").rstrip("'")).split(os.sep)
+    if parts[-1] == "analysis" and len(parts) > 1:
+        return parts[-2]
+    return parts[-1]
+
+
+def _download_time(path: str):
+    """Download time of a data file (YYYYMMDD_HHMMSS) from its name (see ouvrai-download.js), or else its modification time."""
+    match = re.search(r"\d{8}_\d{6}", os.path.basename(path))
+    if match:
+        return match.group()
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime(
+        "%Y%m%d_%H%M%S"
+    )
+
+
+def watch(
+    data_folder: str = "./",
+    file_regex: str = "^data_",
+    save_format: str = "parquet",
+    save_name: str = "df",
+    interval: float = 10,
+    keep: int = 2,
+    workers: int = 1,
+    dtypes: str = None,
+    progress=None,
+    callback=None,
+    max_updates: int = None,
+    frame_format: str = None,
+):
+    """
+    Keep the saved data frames up to date while data are being collected, by wrangling again whenever data files are added or changed (e.g., by 'ouvrai download').
+    Subjects are cached (see load), so only subjects that are new or changed since the last update are parsed.
+    Each update saves new timestamped output files, which readers (e.g., load_table) see only once they are complete, and deletes older outputs.
+    Stop watching with Ctrl+C.
+
+    Parameters
+    ----------
+    data_folder : str, optional
+        Relative path to data, by default "./"
+    file_regex : str, optional
+        Regular expression identifying data files, by default "^data_"
+    save_format : str, optional
+        Output file format (see load), by default "parquet"
+    save_name : str, optional
+        File name prefix of the outputs, by default "df"
+    interval : float, optional
+        Seconds between checks of the data folder, by default 10. A file must be unchanged for one interval before it is wrangled, in case it is still being written.
+    keep : int, optional
+        Number of most recent outputs to keep, by default 2 (so that readers of the previous output are not interrupted)
+    workers : int, optional
+        Number of processes used to read data files (see load), by default 1
+    dtypes : str, optional
+        Data type policy (see load), by default None
+    progress : function, optional
+        Called with a short description of the current stage (see load), by default None
+    callback : function, optional
+        Called with (df_trial, df_subject, df_frame, df_state) after each update, by default None
+    max_updates : int, optional
+        Stop after this many updates, by default None (watch until interrupted)
+    frame_format : str, optional
+        Save the frame table in this format instead of `save_format` (see load), by default None
+    """
+    data_folder = data_folder.lstrip("'").rstrip("'")
+    progress = progress or print
+
+    def scan():
+        """Size and modification time of each data file."""
+        files = {}
+        for entry in os.scandir(data_folder):
+            if entry.is_file() and re.search(file_regex, entry.name):
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    wrangled = None  # state of the data files at the last update
+    updates = 0
+    try:
+        previous = scan()
+        time.sleep(interval)
+        while max_updates is None or updates < max_updates:
+            current = scan()
+            # Wrangle when files have changed, but not since the last check
+            if current and current != wrangled and current == previous:
+                try:
+                    tables = load(
+                        data_folder=data_folder,
+                        file_regex=file_regex,
+                        save_format=save_format,
+                        save_name=save_name,
+                        workers=workers,
+                        cache=True,
+                        dtypes=dtypes,
+                        progress=progress,
+                        frame_format=frame_format,
+                    )
+                    for fmt in {save_format, frame_format or save_format}:
+                        _prune_outputs(data_folder, save_name, fmt, keep)
+                except Exception as e:
+                    # e.g., a malformed data file: keep watching and try again
+                    progress(
+                        f"Failed to update ({type(e).__name__}: {e}). Retrying in {interval} seconds..."
+                    )
+                else:
+                    wrangled = current
+                    updates += 1
+                    progress(
+                        f"Updated {len(tables[1])} subjects at {datetime.datetime.now():%H:%M:%S}. Waiting for new data files..."
+                    )
+                    if callback is not None:
+                        callback(*tables)
+                    if max_updates is not None and updates >= max_updates:
+                        break
+            previous = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def _prune_outputs(data_folder: str, save_name: str, save_format: str, keep: int):
+    """Delete all but the `keep` most recent timestamped outputs in `save_format` (and their schema) named with `save_name`."""
+    extension = save_format.lstrip(".")
+    extension = _COLUMNAR_FORMATS.get(extension) or _EXTENSIONS.get(
+        extension, extension
+    )
+    pattern = re.compile(
+        re.escape(save_name)
+        + r"_(?:(trial|subject|frame|state|schema)_)?(\d{8}_\d{6})\."
+        + f"({extension}|json)$"
+    )
+    outputs, schemas = {}, {}
+    for fn in os.listdir(data_folder):
+        match = pattern.match(fn)
+        if match and match.group(3) == extension:
+            outputs.setdefault(match.group(2), []).append(fn)
+        elif match and match.group(1) == "schema":
+            schemas[match.group(2)] = fn
+    for ts in sorted(outputs)[: max(len(outputs) - keep, 0)]:
+        for fn in outputs[ts] + ([schemas[ts]] if ts in schemas else []):
+            path = os.path.join(data_folder, fn)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def load_table(
+    data_folder: str = "./",
+    table: str = "frame",
+    columns: list = None,
+    subjects: list = None,
+    save_name: str = "df",
+    lazy: bool = False,
+):
+    """
+    Read selected columns and subjects of a data frame saved by `load` in Parquet or Feather format (the most recent one named with `save_name`).
+    Only the requested data is read from disk.
+
+    Parameters
+    ----------
+    data_folder : str, optional
+        Relative path to data, by default "./"
+    table : str, optional
+        Which data frame to read: "trial", "subject", "frame", or "state", by default "frame"
+    columns : list, optional
+        Columns to read, by default None (all columns). The 'subject' and 'trialNumber' columns are always included if they exist.
+    subjects : list, optional
+        Subject codes (e.g. ["000", "001"]) to read, by default None (all subjects)
+    save_name : str, optional
+        File name prefix used when saving the data frames, by default "df"
+    lazy : bool, optional
+        Return a generator that reads one subject at a time instead of a single data frame, by default False
+
+    Returns
+    -------
+    pd.DataFrame or generator
+        The requested data, or a generator of (subject, data frame) tuples if `lazy = True`.
+
+    Raises
+    ------
+    FileNotFoundError
+        If no Parquet or Feather output exists for this table.
+    """
+    data_folder = data_folder.lstrip("'").rstrip("'")
+    paths = [
+        _latest_output(data_folder, save_name, table, extension)
+        for extension in ["parquet", "feather"]
+    ]
+    paths = [x for x in paths if os.path.exists(x)]
+    if len(paths) == 0:
+        raise FileNotFoundError(
+            f"No Parquet or Feather files found for '{save_name}_{table}' in {data_folder}"
+        )
+    path = max(paths)  # most recent
+    extension = path.rsplit(".", 1)[-1]
+
+    if os.path.isdir(path):
+        # Partitioned: one file per subject
+        files = {
+            os.path.splitext(fn)[0]: os.path.join(path, fn)
+            for fn in sorted(os.listdir(path))
+            if fn.endswith(f".{extension}")
+        }
+        if subjects is not None:
+            files = {sb: files[sb] for sb in subjects if sb in files}
+    else:
+        files = {None: path}
+
+    def read(sb, file):
+        read_columns = columns
+        if columns is not None:
+            read_columns = _columnar_keys(file, extension) + [
+                c for c in columns if c not in ["subject", "trialNumber"]
+            ]
+        df = _read_columnar(file, extension, read_columns)
+        if sb is None and subjects is not None:
+            df = df.loc[df["subject"].isin(subjects)].reset_index(drop=True)
+        return df
+
+    if lazy:
+        return ((sb, read(sb, file)) for sb, file in files.items())
+    dfs = [read(sb, file) for sb, file in files.items()]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
+
+def iter_subjects(
+    data_folder: str = "./",
+    file_regex: str = "^data_",
+    source: str = "json",
+    save_name: str = "df",
+    schema: dict = None,
+    dtypes: str = None,
+):
+    """
+    Generator of the data of one subject at a time, for analyses of studies that do not fit in memory.
+    Each subject's data frames are the same as the rows for that subject in the outputs of `load` (subjects are numbered the same way).
+    Only one subject is held in memory at a time.
+
+    Typical usage, with results appended to disk one subject at a time (see append_table):
+    ```
+    for df_trial, df_subject, df_frame, df_state in iter_subjects(data_folder):
+        df_frame = compute_kinematics(df_subject, df_frame)
+        df_trial, df_frame = find_first_velocity_peak(df_trial, df_subject, df_frame)
+        append_table(df_trial, data_folder, "trial")
+        append_table(df_frame, data_folder, "frame")
+    ```
+
+    Parameters
+    ----------
+    data_folder : str, optional
+        Relative path to data, by default "./"
+    file_regex : str, optional
+        Regular expression uniquely identifying data files to load, by default "^data_" (only used if `source = "json"`)
+    source : str, optional
+        Read the raw data files ("json"), or the outputs saved by `load` in "parquet" or "feather" format, by default "json"
+    save_name : str, optional
+        File name prefix of the outputs saved by `load`, by default "df"
+    schema : dict, optional
+        Frame and state-change variables (see infer_schema), by default None (the schema saved by `load` with `save_name`, if any).
+        Otherwise, the schema is inferred for each subject separately.
+    dtypes : str, optional
+        Data type policy (see `load`), by default None
+
+    Yields
+    ------
+    tuple
+        df_trial, df_subject, df_frame, df_state for one subject
+    """
+    data_folder = data_folder.lstrip("'").rstrip("'")
+    if source.lstrip(".") in _COLUMNAR_FORMATS:
+        yield from _iter_saved_subjects(data_folder, save_name)
+        return
+    elif source != "json":
+        raise ValueError(f"Unknown source '{source}'.")
+
+    if schema is None:
+        path = _latest_output(data_folder, save_name, "schema", "json")
+        if os.path.exists(path):
+            with open(path) as f:
+                schema = json.load(f)
+    dir_contents = sorted(os.listdir(data_folder))
+    paths = [data_folder + fn for fn in dir_contents if re.search(file_regex, fn)]
+
+    # Later files take precedence over earlier files when a subject appears in both (as in `load`),
+    # so skip subjects that (probably) appear in a later file, and read them from the later file
+    last_file = {}
+    for fi, path in enumerate(paths):
+        last_file.update(dict.fromkeys(_find_uids(path), fi))
+    numbers = {}  # subjects are numbered in order of first appearance
+    skipped = {}  # subject -> file of the most recent skipped copy
+
+    def tables(s, d):
+        with contextlib.redirect_stdout(io.StringIO()):
+            df_trial, df_subject, df_frame, df_state, _ = _build_tables(
+                {s: _tabulate_subject(d)}, LoadReport(), schema, numbers[s]
+            )
+        return _apply_dtypes((df_trial, df_subject, df_frame, df_state), dtypes)
+
+    for fi, path in enumerate(paths):
+        print(f"Reading {os.path.basename(path)}")
+        for s, d in _iter_json_items(path):
+            if len(s) != 28:
+                warnings.warn(f"Key '{s}' does not look like a Firebase UID!")
+            numbers.setdefault(s, len(numbers))
+            if last_file.get(s, fi) > fi:
+                skipped[s] = path
+                continue
+            skipped.pop(s, None)
+            yield tables(s, d)
+            del d
+        # Keys that only looked like subjects in later files: read the skipped copies
+        missing = [s for s in skipped if last_file[s] == fi]
+        for path in dict.fromkeys(skipped[s] for s in missing):
+            for s, d in _iter_json_items(path):
+                if s in missing and skipped.get(s) == path:
+                    skipped.pop(s)
+                    yield tables(s, d)
+                    del d
+
+
+def _iter_saved_subjects(data_folder: str, save_name: str):
+    """Iterate over subjects in the Parquet or Feather outputs of `load` (see iter_subjects)."""
+    df_trial = load_table(data_folder, "trial", save_name=save_name)
+    df_subject = load_table(data_folder, "subject", save_name=save_name)
+    trials = dict(tuple(df_trial.groupby("subject", sort=False, observed=True)))
+    subjects = dict(tuple(df_subject.groupby("subject", sort=False, observed=True)))
+    for sb, df_frame in load_table(
+        data_folder, "frame", save_name=save_name, lazy=True
+    ):
+        df_state = load_table(data_folder, "state", subjects=[sb], save_name=save_name)
+        yield (
+            trials[sb].reset_index(drop=True),
+            subjects[sb].reset_index(drop=True),
+            df_frame,
+            df_state,
+        )
+
+
+def _find_uids(path: str):
+    """Find the Firebase UIDs that appear as keys of objects in a file, without decoding it (may include some nested keys)."""
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return [x.group(1).decode() for x in _UID_KEY.finditer(m)]
+
+
+def append_table(
+    df: pd.DataFrame,
+    data_folder: str = "./",
+    table: str = "frame",
+    save_name: str = "df_processed",
+    extension: str = "parquet",
+):
+    """
+    Save the data of some subjects to a folder with one Parquet or Feather file per subject, i.e. <save_name>_<table>.<extension>/<subject>.<extension>.
+    Use it to save results one subject at a time (see iter_subjects). Files of subjects that were already saved are replaced.
+    Read the results with `load_table(data_folder, table, save_name=save_name)`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame with a 'subject' column
+    data_folder : str, optional
+        Relative path to data, by default "./"
+    table : str, optional
+        Name of the table, by default "frame"
+    save_name : str, optional
+        File name prefix, by default "df_processed"
+    extension : str, optional
+        "parquet" or "feather", by default "parquet"
+
+    Raises
+    ------
+    ValueError
+        If `df` does not have a 'subject' column.
+    """
+    if "subject" not in df.columns:
+        raise ValueError("Data frame must have a 'subject' column.")
+    data_folder = data_folder.lstrip("'").rstrip("'")
+    extension = _COLUMNAR_FORMATS[extension.lstrip(".")]
+    path = f"{data_folder}{save_name}_{table}.{extension}"
+    _write_columnar(df, path, extension, partition=True)
+
+
+# save_format -> file extension
+_COLUMNAR_FORMATS = {
+    "parquet": "parquet",
+    "pq": "parquet",
+    "feather": "feather",
+    "arrow": "feather",
+    "ipc": "feather",
+}
+
+# other save_format -> file extension
+_EXTENSIONS = {"pickle": "pkl", "txt": "csv", "xls": "xlsx", "excel": "xlsx"}
+
+
+def _write_columnar(df: pd.DataFrame, path: str, extension: str, partition: bool):
+    """Save a data frame in Parquet or Feather format, optionally as a folder with one file per subject."""
+    if not partition:
+        if extension == "parquet":
+            df.to_parquet(path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(path)
+        return
+    os.makedirs(path, exist_ok=True)
+    for sb, df_sb in df.groupby("subject", sort=False, observed=True):
+        _write_columnar(
+            df_sb, os.path.join(path, f"{sb}.{extension}"), extension, False
+        )
+
+
+def _read_columnar(path: str, extension: str, columns: list = None):
+    """Read a Parquet or Feather file, optionally only some of the columns."""
+    if extension == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_feather(path, columns=columns)
+
+
+def _columnar_keys(path: str, extension: str):
+    """Get the identifier columns ('subject', 'trialNumber') that exist in a Parquet or Feather file, without reading the data."""
+    import pyarrow, pyarrow.parquet
+
+    if extension == "parquet":
+        names = pyarrow.parquet.read_schema(path).names
+    else:
+        with pyarrow.memory_map(path) as source:
+            names = pyarrow.ipc.open_file(source).schema.names
+    return [c for c in ["subject", "trialNumber"] if c in names]
+
+
+def _latest_output(data_folder: str, save_name: str, table: str, extension: str):
+    """
+    Get the path of the most recently saved output file for one table, i.e. <save_name>_<table>_<timestamp>.<extension>.
+    Falls back to <save_name>_<table>.<extension> if there are no timestamped files.
+    """
+    timestamped = glob.glob(
+        glob.escape(f"{data_folder}{save_name}_{table}_") + f"*.{extension}"
+    )
+    if len(timestamped) > 0:
+        return max(timestamped)  # timestamps sort chronologically
+    return f"{data_folder}{save_name}_{table}.{extension}"
+
+
+def _wrangle(
+    data_folder: str,
+    file_regex: str,
+    workers: int,
+    cache: bool,
+    dtypes: str,
+    report,
+):
+    """Read the data files in `data_folder` that match `file_regex` into data frames (see load), returning them with their schema (see infer_schema)."""
+    dir_contents = sorted(os.listdir(data_folder))  # contents of the data folder
+    filenames = [fn for fn in dir_contents if re.search(file_regex, fn)]
+
+    paths = [data_folder + fn for fn in filenames]  # prefix with data_folder
+    cache_folder = os.path.join(data_folder, ".ouvrai_cache") if cache else None
+    subjects = _read_subjects(paths, workers, cache_folder, report)
+
+    df_trial, df_subject, df_frame, df_state, schema = _build_tables(subjects, report)
+    del subjects
+
+    # [DEPRECATED] Transform "stateNames" into a dictionary mapping from integer codes to names
+    # df_subject["stateNames"] = df_subject["stateNames"].transform(
+    #     lambda x: {id: name for id, name in enumerate(x)}
+    # )
+    # df_frame["state"] = rename_states(df_frame, df_subject)
+    # df_state["state"] = rename_states(df_state, df_subject, state_col="stateChange")
+
+    df_trial, df_subject, df_frame, df_state = _apply_dtypes(
+        (df_trial, df_subject, df_frame, df_state), dtypes, report
+    )
+
+    return df_trial, df_subject, df_frame, df_state, schema
+
+
+def _read_subjects(
+    paths: list, workers: int, cache_folder: str, report, sources: dict = None
+):
+    """
+    Collect data one subject at a time from data files, optionally in parallel (see _read_json_files).
+    Later files take precedence over earlier files when a subject appears in both.
+    If `sources` is given, the paths of the files in which each subject appears are added to it (by UID).
+
+    Returns
+    -------
+    dict
+        Output of _tabulate_subject for each subject UID, in order of first appearance
+    """
+    subjects = {}
+    report.start("Reading data files")
+    started = time.time()
+    files = _read_json_files(paths, workers, cache_folder)
+    for fi, (path, (shards, uids_ok)) in enumerate(zip(paths, files)):
+        if not uids_ok:
+            warnings.warn("Keys do not look like Firebase UIDs! Check your files.")
+        nsubjects = 0
+        for s, tabulated in itertools.chain.from_iterable(shards):
+            subjects[s] = tabulated
+            nsubjects += 1
+            if sources is not None:
+                sources.setdefault(s, []).append(path)
+        report.add_file(path, nsubjects)
+        report.step(fi + 1, len(paths))
+    if cache_folder is not None:
+        _prune_cache(cache_folder, started)
+    return subjects
+
+
+def _prune_cache(cache_folder: str, since: float):
+    """Delete cached subjects that were not written or used since `since` (see _read_json_cached)."""
+    for entry in os.scandir(cache_folder):
+        # small margin for file systems with coarse modification times
+        if entry.name.endswith(".pkl") and entry.stat().st_mtime < since - 2:
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+
+
+def _save_outputs(
+    tables: dict,
+    schema: dict,
+    data_folder: str,
+    save_name: str,
+    save_format: str,
+    frame_format: str,
+    report,
+):
+    """Save the data frames returned by load as timestamped files (see load), and their schema."""
+    report.start("Saving")
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Trial and subject tables are written last, so readers never see trials without frames
+    tables = {k: tables[k] for k in ["frame", "state", "trial", "subject"]}
+    if frame_format is not None and save_format is not None:
+        # e.g., frame table to Parquet and other tables to Excel
+        if not _save_tables(
+            {"frame": tables.pop("frame")}, data_folder, save_name, frame_format, ts
+        ):
+            raise ValueError(f"Unknown frame_format '{frame_format}'.")
+    if not _save_tables(tables, data_folder, save_name, save_format, ts):
+        schema = None
+    if schema is not None:
+        # Keep the schema with the outputs, e.g. to check it before loading them
+        with _atomic_path(f"{data_folder}{save_name}_schema_{ts}.json") as tmp:
+            with open(tmp, "w") as f:
+                json.dump(schema, f, indent=2)
+
+
+def _save_tables(
+    tables: dict, data_folder: str, save_name: str, save_format: str, ts: str
+):
+    """
+    Save data frames (by table name) as <save_name>_<table>_<ts>.<extension>, or in a single workbook <save_name>_<ts>.xlsx.
+    Each file is written under a temporary name and then renamed (see _atomic_path).
+
+    Returns
+    -------
+    bool
+        False if `save_format` is None or unknown (nothing saved)
+    """
+    if save_format in {"pkl", ".pkl", "pickle"}:
+        for table, df in tables.items():
+            with _atomic_path(f"{data_folder}{save_name}_{table}_{ts}.pkl") as tmp:
+                df.to_pickle(tmp)
+    elif save_format in {"csv", "txt", ".csv", ".txt"}:
+        for table, df in tables.items():
+            with _atomic_path(f"{data_folder}{save_name}_{table}_{ts}.csv") as tmp:
+                df.to_csv(tmp)
+    elif save_format in {"xls", "xlsx", ".xls", ".xlsx", "excel"}:
+        # Usual sheet order
+        names = ["trial", "subject", "frame", "state"]
+        tables = {
+            k: tables[k] for k in sorted(tables, key=(names + list(tables)).index)
+        }
+        with _atomic_path(data_folder + save_name + "_" + ts + ".xlsx") as tmp:
+            write_excel(tables, tmp)
+    elif save_format is not None and save_format.lstrip(".") in _COLUMNAR_FORMATS:
+        # Frame and state tables are partitioned into one file per subject
+        extension = _COLUMNAR_FORMATS[save_format.lstrip(".")]
+        for table, df in tables.items():
+            path = f"{data_folder}{save_name}_{table}_{ts}.{extension}"
+            with _atomic_path(path) as tmp:
+                _write_columnar(df, tmp, extension, table in {"frame", "state"})
+    else:
+        return False
+    return True
+
+
+# Rows per worksheet in Excel (including the header)
+_EXCEL_MAX_ROWS = 1048576
+
+
+def write_excel(
+    tables: dict, path: str, index: bool = True, max_rows: int = _EXCEL_MAX_ROWS
+):
+    """
+    Save data frames to an Excel workbook, one sheet per data frame, streaming rows to disk so that memory use does not grow with the size of the tables.
+    Data frames with more rows than fit in a worksheet are split across numbered sheets, e.g. 'frame_1', 'frame_2', ...
+
+    Parameters
+    ----------
+    tables : dict
+        Data frames by sheet name, e.g. {"trial": df_trial, "frame": df_frame}
+    path : str
+        Path of the .xlsx file
+    index : bool, optional
+        Write the index as the first column (as with pd.DataFrame.to_excel), by default True
+    max_rows : int, optional
+        Maximum number of rows per sheet, including the header, by default 1048576 (the limit of Excel)
+    """
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    for name, df in tables.items():
+        header = ([df.index.name] if index else []) + [str(c) for c in df.columns]
+        per_sheet = max_rows - 1
+        nsheets = max(int(np.ceil(len(df) / per_sheet)), 1)
+        for i in range(nsheets):
+            sheet = workbook.create_sheet(name if nsheets == 1 else f"{name}_{i + 1}")
+            sheet.append(header)
+            stop = min((i + 1) * per_sheet, len(df))
+            for start in range(i * per_sheet, stop, 2**14):
+                rows = df.iloc[start : min(start + 2**14, stop)]
+                for row in _excel_rows(rows, index):
+                    sheet.append(row)
+    workbook.save(path)
+
+
+def _excel_rows(df: pd.DataFrame, index: bool):
+    """Rows of a data frame as tuples of values that openpyxl can write, with missing values as empty cells (as with pd.DataFrame.to_excel)."""
+    columns = ([df.index] if index else []) + [df[col] for col in df.columns]
+    values = []
+    for col in columns:
+        x = np.array(col, dtype=object)
+        x[pd.isna(x)] = None
+        if col.dtype.kind in "iuf":
+            # infinite values are written as text (cf. inf_rep)
+            inf = np.isin(x, [np.inf, -np.inf])
+            x[inf] = [str(v) for v in x[inf]]
+        elif col.dtype.kind != "b":
+            # e.g., lists and dictionaries are written as text
+            x = [
+                (
+                    v
+                    if v is None or isinstance(v, (str, int, float, datetime.date))
+                    else str(v)
+                )
+                for v in x
+            ]
+        values.append(x)
+    return zip(*values)
+
+
+@contextlib.contextmanager
+def _atomic_path(path: str):
+    """
+    Temporary path in the same folder as `path`, which is renamed to `path` once it has been written.
+    Readers never see a partially written file (or folder of partitioned files).
+    """
+    folder, name = os.path.split(path)
+    tmp = os.path.join(folder, f".tmp{os.getpid()}_{name}")
+    try:
+        yield tmp
+        if os.path.isdir(path):
+            shutil.rmtree(path)  # a folder cannot replace another folder
+        os.replace(tmp, path)
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class _TableBuilder:
+    """
+    Accumulate rows of a data frame in column buffers so the data frame can be built once at the end.
+    Columns are ordered by first appearance. Cells in columns that are missing from some rows are filled with NaN.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.nrows = 0
+
+    def _column(self, name):
+        # Get a column buffer, padded with NaN up to the current number of rows
+        col = self.columns.setdefault(name, [])
+        if len(col) < self.nrows:
+            col.extend([np.nan] * (self.nrows - len(col)))
+        return col
+
+    def append(self, row: dict):
+        """Add one row, given as a dictionary of column names and values."""
+        for name, value in row.items():
+            self._column(name).append(value)
+        self.nrows += 1
+
+    def extend(self, block):
+        """
+        Add the rows of another _TableBuilder, or add columns to the existing rows if `block` is a dictionary of equal-length lists.
+        """
+        if isinstance(block, _TableBuilder):
+            for name, values in block.columns.items():
+                self._column(name).extend(values)
+            self.nrows += block.nrows
+        else:
+            for name, values in block.items():
+                self._column(name)[self.nrows - len(values) :] = values
+
+    def build(self):
+        """Create the data frame."""
+        for name in self.columns:
+            self._column(name)
+        return pd.DataFrame(self.columns, index=pd.RangeIndex(self.nrows))
+
+
+def _flatten_dict(d: dict, sep: str = "."):
+    """
+    Flatten nested dictionaries into a single level like `pd.json_normalize`, i.e. {"homePosn": {"x": 0}} becomes {"homePosn.x": 0}.
+    """
+    flat = {k: v for k, v in d.items() if not isinstance(v, dict)}
+
+    def recurse(prefix, nested):
+        for k, v in nested.items():
+            if isinstance(v, dict):
+                recurse(f"{prefix}{k}{sep}", v)
+            else:
+                flat[f"{prefix}{k}"] = v
+
+    recurse("", {k: v for k, v in d.items() if isinstance(v, dict)})
+    return flat
+
+
+class _RaggedBuilder:
+    """
+    Accumulate per-trial lists of values (e.g., frame data) in flat column buffers, along with the length of each list.
+    Lists of objects (e.g., Vector3 or Quaternion) are flattened into separate buffers for each property.
+    Long-format data frames can then be assembled using the trial offsets (cumulative lengths), without exploding lists.
+    """
+
+    def __init__(self, ntrials: int = 0):
+        self.ntrials = ntrials
+        # variable -> chunks of list lengths per trial (-1 if missing)
+        self.lengths = {}
+        # variable -> total number of values
+        self.nrows = {}
+        # variable -> {property (None if not an object) -> chunks of values}
+        self.columns = {}
+
+    def add(self, name: str, lists: list):
+        """
+        Add a new variable from a list of lists, one per trial (None if missing from a trial).
+        """
+        lengths = np.array([-1 if x is None else len(x) for x in lists], dtype=int)
+        values = list(itertools.chain.from_iterable(x for x in lists if x is not None))
+        if len(lengths) != self.ntrials:
+            raise ValueError(f"Expected {self.ntrials} lists for '{name}'.")
+
+        types = set(map(type, values))
+        if dict not in types:
+            properties = {None: _as_array(values)}
+        else:
+            # Missing values (e.g. -9999) become NaN
+            if types != {dict}:
+                values = [x if isinstance(x, dict) else {} for x in values]
+            try:
+                # Fast path when every object has the same properties
+                if len(set(map(len, values))) > 1:
+                    raise KeyError
+                properties = {
+                    k: list(map(operator.itemgetter(k), values)) for k in values[0]
+                }
+            except KeyError:
+                keys = dict.fromkeys(
+                    itertools.chain.from_iterable(dict.fromkeys(map(tuple, values)))
+                )
+                properties = {
+                    k: list(map(operator.methodcaller("get", k, np.nan), values))
+                    for k in keys
+                }
+            # Vector3, Quaternion, and Euler dimensions are always float
+            properties = {
+                k: _as_array(
+                    x, float if k.lstrip("_") in {"x", "y", "z", "w"} else None
+                )
+                for k, x in properties.items()
+            }
+
+        self.lengths[name] = [lengths]
+        self.nrows[name] = len(values)
+        self.columns[name] = {k: [x] for k, x in properties.items()}
+
+    def extend(self, other):
+        """Add the trials of another _RaggedBuilder."""
+        for name in self.lengths.keys() - other.lengths.keys():
+            self.lengths[name].append(np.full(other.ntrials, -1))
+        for name, lengths in other.lengths.items():
+            if name not in self.lengths:
+                self.lengths[name] = [np.full(self.ntrials, -1)]
+                self.nrows[name] = 0
+                self.columns[name] = {}
+            self.lengths[name].extend(lengths)
+            columns = self.columns[name]
+            for k in columns.keys() - other.columns[name].keys():
+                columns[k].append(np.full(other.nrows[name], np.nan))
+            for k, chunks in other.columns[name].items():
+                if k not in columns:
+                    columns[k] = [np.full(self.nrows[name], np.nan)]
+                columns[k].extend(chunks)
+            self.nrows[name] += other.nrows[name]
+        self.ntrials += other.ntrials
+
+    def drop_trials(self, name: str, trials: np.ndarray):
+        """Remove the values of one variable from some trials (given as indices), as if they were missing."""
+        lengths = np.concatenate(self.lengths[name]).astype(int)
+        keep = np.ones(len(lengths), dtype=bool)
+        keep[trials] = False
+        rows = np.repeat(keep, np.maximum(lengths, 0))
+        for k, chunks in self.columns[name].items():
+            values = _concat_chunks(chunks)
+            if isinstance(values, np.ndarray):
+                values = values[rows]
+            else:
+                values = list(itertools.compress(values, rows))
+            self.columns[name][k] = [values]
+        lengths[~keep] = -1
+        self.lengths[name] = [lengths]
+        self.nrows[name] = int(rows.sum())
+
+    def trial_lengths(self):
+        """Get a dictionary of arrays of list lengths for each variable (-1 if missing from a trial)."""
+        return {
+            name: np.concatenate(chunks).astype(int)
+            for name, chunks in self.lengths.items()
+        }
+
+    def build(self, names: list, df_id: pd.DataFrame, reference: str):
+        """
+        Assemble some of the variables in a long-format data frame, with one row for each list element.
+
+        Parameters
+        ----------
+        names : list
+            Names of the variables to include. Every trial must have the same number of values for each variable (or none).
+        df_id : pd.DataFrame
+            Trial-level data frame (one row per trial) containing columns that should be repeated on every row, e.g. 'subject' and 'trialNumber'
+        reference : str
+            Name of the variable that determines the number of rows for each trial.
+
+        Returns
+        -------
+        pd.DataFrame
+            Long-format data frame
+
+        Raises
+        ------
+        ValueError
+            If a trial has lists of different lengths.
+        """
+        ref_lengths = np.concatenate(self.lengths[reference]).astype(int)
+        counts = np.maximum(ref_lengths, 0)
+        out = {}
+        expanded = {}
+        for name in names:
+            lengths = np.concatenate(self.lengths[name]).astype(int)
+            present = lengths >= 0
+            bad = np.flatnonzero(present & (lengths != ref_lengths))
+            if bad.size > 0:
+                raise ValueError(
+                    f"'{name}' and '{reference}' have different numbers of values in trial {bad[0]} of df_trial."
+                )
+            rows = None if present.all() else np.repeat(present, counts)
+            for k, chunks in self.columns[name].items():
+                values = _concat_chunks(chunks)
+                if rows is not None:
+                    # Missing from some trials: fill with NaN
+                    filled = np.full(
+                        len(rows),
+                        np.nan,
+                        dtype=float if _is_numeric(values) else object,
+                    )
+                    filled[rows] = values
+                    values = filled
+                if k is None:
+                    out[name] = values
+                else:
+                    # Three.js orientation dimensions already have underscores
+                    # Don't allow repeated underscores
+                    expanded[re.sub("_+", "_", f"{name}_{k}")] = values
+            if None not in self.columns[name]:
+                print(
+                    f"Expanded {name} to {[re.sub('_+', '_', f'{name}_{k}') for k in self.columns[name]]}"
+                )
+
+        idx = np.repeat(np.arange(self.ntrials), counts)
+        for c in df_id.columns:
+            out[c] = df_id[c].take(idx).reset_index(drop=True)
+
+        return pd.DataFrame({**out, **expanded}, index=pd.RangeIndex(counts.sum()))
+
+    def to_lists(self, name: str):
+        """Reassemble one variable as a list of values per trial (NaN if missing from a trial)."""
+        lengths = np.concatenate(self.lengths[name]).astype(int)
+        ends = np.cumsum(np.maximum(lengths, 0))
+        columns = {
+            k: _concat_chunks(chunks) for k, chunks in self.columns[name].items()
+        }
+        columns = {
+            k: x.tolist() if isinstance(x, np.ndarray) else x
+            for k, x in columns.items()
+        }
+        if None in columns:
+            values = columns[None]
+        else:
+            values = [dict(zip(columns, x)) for x in zip(*columns.values())]
+        return [
+            values[end - n : end] if n >= 0 else np.nan for end, n in zip(ends, lengths)
+        ]
+
+
+def _build_tables(subjects: dict, report, schema: dict = None, first_subject: int = 0):
+    """
+    Arrange tabulated subjects in the data frames returned by `load`.
+
+    Parameters
+    ----------
+    subjects : dict
+        Output of _tabulate_subject for each subject UID, in order
+    report : LoadReport
+        Report in which the duration of each stage is recorded
+    schema : dict, optional
+        Known frame and state-change variables (see infer_schema), by default None (infer from these subjects only)
+    first_subject : int, optional
+        Number of the first subject, by default 0 (i.e. subject "000")
+
+    Returns
+    -------
+    tuple
+        df_trial, df_subject, df_frame, df_state, and the schema
+    """
+    report.start("Building trial and subject tables")
+
+    # Arrange it in data frames, built once from column buffers
+    trials = _TableBuilder()
+    lists = _RaggedBuilder()
+    infos = _TableBuilder()
+    for si, (s, (trial_columns, trial_lists, info)) in enumerate(
+        subjects.items(), first_subject
+    ):
+        n = trial_columns.nrows
+        trial_columns.extend({"subject": ["{:0>3}".format(si)] * n, "uid": [s] * n})
+        trials.extend(trial_columns)
+        lists.extend(trial_lists)
+        info["subject"] = "{:0>3}".format(si)
+        info["uid"] = s
+        infos.append(info)
+    df_trial = trials.build()
+    df_subject = infos.build()
+    del trials, infos
+
+    report.start("Inferring schema")
+    # Separate list-type columns containing frame data or state-change data
+    # using the lengths of the lists in all trials (see infer_schema)
+    schema = infer_schema(lists.trial_lengths(), known=schema)
+    frame_columns = schema["frame"]
+    print(f"Frame variables are: {frame_columns}")
+    statechange_columns = schema["state"]
+    print(f"State change variables are: {statechange_columns}")
+    # Treat inconsistent values as missing instead of misaligning them
+    for c, bad in schema["inconsistent"].items():
+        trials = df_trial.loc[bad, ["subject", "trialNumber"]]
+        schema["inconsistent"][c] = trials.values.tolist()
+        warnings.warn(
+            f"'{c}' has the wrong number of values in {len(bad)} trials (set to missing), "
+            f"e.g., subject {trials.iloc[0, 0]}, trial {trials.iloc[0, 1]}."
+        )
+        lists.drop_trials(c, bad)
+    report.start("Building frame and state tables")
+    # Remove these columns from df_trial and assemble them in long format in their own DataFrames
+    # Information that is missing from the new DataFrames is repeated from df_trial
+    df_frame = lists.build(
+        frame_columns,
+        df_trial[[c for c in ["subject", "trialNumber", "cycle"] if c in df_trial]],
+        "t",
+    )
+    df_state = lists.build(
+        statechange_columns,
+        df_trial[[c for c in ["subject", "trialNumber"] if c in df_trial]],
+        "stateChange",
+    )
+    # Other list-type columns remain in df_trial as one list per trial
+    for c in lists.lengths:
+        if c in frame_columns or c in statechange_columns:
+            df_trial.pop(c)
+        else:
+            df_trial[c] = lists.to_lists(c)
+    del lists
+
+    # Sometimes t is dtype 'object' due to mix of ints and floats
+    df_frame["t"] = df_frame["t"].astype(float)
+
+    # Expand any object columns (typically x,y,z)
+    report.start("Expanding object columns")
+    df_trial = expand_object_columns(df_trial)
+    df_subject = expand_object_columns(df_subject)
+    df_frame = expand_object_columns(df_frame)
+    df_state = expand_object_columns(df_state)
+
+    return df_trial, df_subject, df_frame, df_state, schema
+
+
+def infer_schema(
+    lengths: dict,
+    frame_reference: str = "t",
+    state_reference: str = "stateChange",
+    known: dict = None,
+):
+    """
+    Classify list variables as frame variables (one value per frame) or state-change variables (one value per state change),
+    by comparing the lengths of their lists with those of the reference variables in every trial.
+
+    A variable belongs to a table when its lengths match the reference in most trials, not counting trials where both references have the same length.
+    Trials where they do not match are flagged as inconsistent. Other variables remain in df_trial as one list per trial.
+
+    Parameters
+    ----------
+    lengths : dict
+        Array of list lengths per trial for each variable, -1 where the variable is missing
+    frame_reference : str, optional
+        Variable with one value per frame, by default "t"
+    state_reference : str, optional
+        Variable with one value per state change, by default "stateChange"
+    known : dict, optional
+        Lists of "frame" and "state" variables that are already known (e.g., from a previously saved schema), by default None
+
+    Returns
+    -------
+    dict
+        Lists of "frame" and "state" variables, and "inconsistent" trial indices for each variable
+    """
+    schema = {"frame": [], "state": [], "inconsistent": {}}
+    references = {"frame": frame_reference, "state": state_reference}
+    references = {k: lengths[v] for k, v in references.items() if v in lengths}
+    informative = np.logical_and.reduce([n >= 0 for n in references.values()])
+    if len(references) == 2:
+        informative &= references["frame"] != references["state"]
+    for name, n in lengths.items():
+        present = n >= 0
+        matches = {k: present & (n == ref) for k, ref in references.items()}
+        if name in {frame_reference, state_reference}:
+            table = "frame" if name == frame_reference else "state"
+        elif known is not None and name in known["frame"] + known["state"]:
+            table = "frame" if name in known["frame"] else "state"
+        else:
+            # Fall back on all trials if every trial has as many frames as state changes
+            trials = present & informative if (present & informative).any() else present
+            votes = {
+                k: x[trials].mean() if trials.any() else 0 for k, x in matches.items()
+            }
+            table = max(votes, key=votes.get, default=None)  # frame wins ties
+            if table is None or votes[table] <= 0.5:
+                continue
+        schema[table].append(name)
+        bad = np.flatnonzero(present & ~matches[table])
+        if bad.size > 0:
+            schema["inconsistent"][name] = bad
+    return schema
+
+
+def _as_array(values: list, dtype=None):
+    """Convert a list of JSON values to a NumPy array if they are all numbers or all booleans, otherwise return the list."""
+    types = set(map(type, values))
+    try:
+        if types <= {int, float}:
+            return np.array(
+                values, dtype=dtype or (float if float in types else np.int64)
+            )
+        elif types == {bool}:
+            return np.array(values, dtype=dtype or bool)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return values
+
+
+def _is_numeric(values):
+    return isinstance(values, np.ndarray) and values.dtype.kind in "iuf"
+
+
+def _concat_chunks(chunks: list):
+    """Concatenate buffers created by _as_array, as an array if they have compatible types, otherwise as a list."""
+    chunks = [x for x in chunks if len(x) > 0]
+    if len(chunks) == 0:
+        return np.array([])
+    kinds = {x.dtype.kind if isinstance(x, np.ndarray) else "O" for x in chunks}
+    if "O" not in kinds and (len(kinds) == 1 or kinds <= {"i", "u", "f"}):
+        return np.concatenate(chunks)
+    return list(itertools.chain.from_iterable(chunks))
+
+
+def _tabulate_subject(d: dict):
+    """
+    Arrange the Firebase data from one subject into column buffers.
+
+    Parameters
+    ----------
+    d : dict
+        Data from one subject (one Firebase UID), with one item per trial and an 'info' item.
+
+    Returns
+    -------
+    tuple
+        (trial_columns, trial_lists, info) where trial_columns is a _TableBuilder with one row per trial,
+        trial_lists is a _RaggedBuilder containing the list-type trial data (e.g. frame data), and info is a flat dictionary.
+    """
+    info = _flatten_dict(d.pop("info"))  # separate out the 'info'
+    trial_columns = _TableBuilder()
+    lists = {}
+    for ti, trial in enumerate(d.values()):
+        row = {}
+        for k, v in trial.items():
+            if isinstance(v, list):
+                lists.setdefault(k, [None] * ti)
+                row[k] = None  # placeholder to keep the column order
+            else:
+                row[k] = v
+        for k, x in lists.items():
+            x.append(trial.get(k) if isinstance(trial.get(k), list) else None)
+        trial_columns.append(row)
+    trial_lists = _RaggedBuilder(trial_columns.nrows)
+    for k, x in lists.items():
+        trial_lists.add(k, x)
+    return trial_columns, trial_lists, info
+
+
+def _read_json_files(paths: list, workers: int = 1, cache_folder: str = None):
+    """
+    Read and tabulate the subjects in Firebase exports, optionally in parallel.
+    With multiple workers, each file is read in a separate process, and large files are split into several shards (see _find_json_shards).
+
+    Parameters
+    ----------
+    paths : list
+        Paths to JSON files containing Firebase data
+    workers : int, optional
+        Number of worker processes, by default 1 (read in this process, one subject at a time). If None, use all CPU cores.
+    cache_folder : str, optional
+        Folder where tabulated subjects are cached, by default None (no cache; see _read_json_cached)
+
+    Yields
+    ------
+    tuple
+        (shards, uids_ok) for each file in order, where shards is a list of lists of (uid, _tabulate_subject output) in file order.
+    """
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(paths) == 0:
+        for path in paths:
+            print(f"Reading {os.path.basename(path)}")
+            subjects, uids_ok = _read_json_shard(path, cache_folder=cache_folder)
+            yield [subjects], uids_ok
+        return
+
+    sizes = [os.path.getsize(path) for path in paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for path, size in zip(paths, sizes):
+            # Split files into shards in proportion to their size
+            nshards = int(np.ceil(workers * size / max(sum(sizes), 1)))
+            futures.append(
+                [
+                    executor.submit(_read_json_shard, path, start, stop, cache_folder)
+                    for start, stop in _find_json_shards(path, nshards)
+                ]
+            )
+        for path, file_futures in zip(paths, futures):
+            print(f"Reading {os.path.basename(path)}")
+            try:
+                results = [future.result() for future in file_futures]
+            except (ValueError, json.JSONDecodeError):
+                if len(file_futures) == 1:
+                    raise
+                # Shard boundaries were not actually between subjects
+                results = [
+                    executor.submit(
+                        _read_json_shard, path, cache_folder=cache_folder
+                    ).result()
+                ]
+            yield [x[0] for x in results], all(x[1] for x in results)
+
+
+def _iter_json_items(
+    path: str, start: int = 0, stop: int = None, chunk_size: int = 2**24
+):
+    """
+    Incrementally decode the top-level items of a JSON object stored in a file.
+    Only one value (i.e., one subject in a Firebase export) is held in memory at a time, instead of the whole file.
+
+    Parameters
+    ----------
+    path : str
+        Path to a JSON file whose top level is an object, e.g. {uid: subject_data, ...}
+    start : int, optional
+        Byte offset at which to start decoding, by default 0 (the opening brace).
+        Otherwise must be the offset of a comma that separates two top-level items (see _find_json_shards).
+    stop : int, optional
+        Byte offset at which to stop decoding, by default None (the end of the file).
+        Otherwise must be the offset of a comma that separates two top-level items.
+    chunk_size : int, optional
+        Number of bytes to read from the file at a time, by default 2**24
+
+    Yields
+    ------
+    tuple
+        (key, value) pairs in the order they appear in the file.
+
+    Raises
+    ------
+    ValueError
+        If the file does not contain a JSON object, is truncated, or `start`/`stop` are not item boundaries.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[ \t\n\r]*")
+    text_decoder = codecs.getincrementaldecoder(
+        "utf-8-sig" if start == 0 else "utf-8"
+    )()
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if stop is None else stop - start
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            # Drop consumed text and read more, doubling the read size with the unconsumed text so that
+            # repeated attempts to decode a very large value take linear (not quadratic) time overall
+            nonlocal buf, pos, eof, remaining
+            size = max(chunk_size, len(buf) - pos)
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            chunk = f.read(size)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + text_decoder.decode(chunk, final=eof)
+            pos = 0
+
+        def next_char():
+            # Skip whitespace and return the next character without consuming it
+            nonlocal pos
+            while True:
+                pos = whitespace.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    return buf[pos : pos + 1]
+                fill()
+
+        def decode():
+            # Decode one complete JSON value, reading more of the file as needed
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # A number at the very end of the buffer may continue in the next chunk
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def items(nested):
+            # Decode the items of the object at the current position one at a time
+            # If nested, values that are objects are also decoded one item at a time,
+            # so that a failed attempt to decode a value from an incomplete buffer wastes less work
+            nonlocal pos
+            if next_char() == "}":
+                pos += 1
+                return
+            while True:
+                next_char()
+                key = decode()
+                if next_char() != ":":
+                    raise ValueError(f"Expected ':' after key '{key}' in {path}.")
+                pos += 1
+                if next_char() == "{" and nested:
+                    pos += 1
+                    value = dict(items(False))
+                else:
+                    value = decode()
+                yield key, value
+                c = next_char()
+                if c == "" and nested and stop is not None:
+                    return  # end of a shard
+                pos += 1
+                if c == "}":
+                    return
+                elif c != ",":
+                    raise ValueError(
+                        f"Expected ',' or '}}' after key '{key}' in {path}."
+                    )
+
+        if next_char() != ("{" if start == 0 else ","):
+            raise ValueError(f"{path} does not contain a JSON object at byte {start}.")
+        pos += 1
+        yield from items(True)
+        if next_char() != "" or (stop is not None and remaining > 0):
+            raise ValueError(
+                f"Unexpected data after the end of the JSON object in {path}."
+            )
+
+
+def _find_json_shards(path: str, nshards: int):
+    """
+    Split a Firebase export into byte ranges containing roughly equal numbers of bytes, at boundaries between subjects.
+    Boundaries are located by searching for Firebase UID keys (28 alphanumeric characters) near evenly spaced offsets.
+    A match may occasionally be a nested key rather than a subject, in which case _iter_json_items fails for the shards.
+
+    Parameters
+    ----------
+    path : str
+        Path to a JSON file containing Firebase data
+    nshards : int
+        Maximum number of shards
+
+    Returns
+    -------
+    list
+        (start, stop) byte offsets for _iter_json_items
+    """
+    size = os.path.getsize(path)
+    if nshards <= 1 or size == 0:
+        return [(0, None)]
+    uid_key = re.compile(rb',\s*"[A-Za-z0-9]{28}"\s*:\s*\{')
+    boundaries = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        for k in range(1, nshards):
+            match = uid_key.search(m, max(boundaries[-1] + 1, k * size // nshards))
+            if match is None:
+                break
+            boundaries.append(match.start())
+    boundaries = sorted(set(boundaries))
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+def _read_json_shard(
+    path: str, start: int = 0, stop: int = None, cache_folder: str = None
+):
+    """
+    Read and tabulate the subjects in (part of) a Firebase export. Runs in worker processes if load(workers > 1).
+
+    Parameters
+    ----------
+    path : str
+        Path to a JSON file containing Firebase data
+    start : int, optional
+        Byte offset at which to start reading, by default 0 (see _iter_json_items)
+    stop : int, optional
+        Byte offset at which to stop reading, by default None (see _iter_json_items)
+    cache_folder : str, optional
+        Folder where tabulated subjects are cached, by default None (no cache; see _read_json_cached)
+
+    Returns
+    -------
+    tuple
+        (subjects, uids_ok) where subjects is a list of (uid, _tabulate_subject output) and uids_ok is False if any keys do not look like Firebase UIDs.
+    """
+    if cache_folder is not None:
+        try:
+            return _read_json_cached(path, start, stop, cache_folder), True
+        except (ValueError, json.JSONDecodeError):
+            pass  # not all keys are Firebase UIDs, so read without the cache
+    subjects = []
+    uids_ok = True
+    for s, d in _iter_json_items(path, start, stop):
+        uids_ok = uids_ok and len(s) == 28
+        subjects.append((s, _tabulate_subject(d)))
+    return subjects, uids_ok
+
+
+# Firebase UID as a key of an object, preceded by "{" or ","
+_UID_KEY = re.compile(rb'[{,]\s*"([A-Za-z0-9]{28})"\s*:\s*\{')
+# Increment to invalidate cached subjects when _tabulate_subject changes
+_CACHE_VERSION = b"1"
+
+
+def _read_json_cached(path: str, start: int, stop: int, cache_folder: str):
+    """
+    Read and tabulate the subjects in (part of) a Firebase export, reusing subjects that were previously tabulated.
+    Subjects are located by searching the raw bytes for Firebase UID keys, and are cached by a hash of their raw bytes.
+    Only subjects that are new or changed since they were cached are decoded and tabulated.
+
+    Parameters
+    ----------
+    path : str
+        Path to a JSON file containing Firebase data
+    start : int
+        Byte offset at which to start reading (see _iter_json_items)
+    stop : int
+        Byte offset at which to stop reading (see _iter_json_items)
+    cache_folder : str
+        Folder containing one pickle file per cached subject, named <uid>_<hash>.pkl.
+        The modification time of each file is the last time it was used.
+
+    Returns
+    -------
+    list
+        (uid, _tabulate_subject output) for each subject in file order
+
+    Raises
+    ------
+    ValueError
+        If any top-level key is not a Firebase UID, or a UID key is found that is not a top-level key.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    subjects = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        end = len(m) if stop is None else stop
+        matches = list(_UID_KEY.finditer(m, start, end))
+        if len(matches) == 0 or m[start : matches[0].start()].strip(
+            b" \t\n\r\xef\xbb\xbf"
+        ):
+            raise ValueError(f"Keys do not look like Firebase UIDs in {path}.")
+        bounds = [start] + [x.start() for x in matches[1:]] + [stop]
+        for match, a, b in zip(matches, bounds[:-1], bounds[1:]):
+            uid = match.group(1).decode()
+            # Raw bytes of this item, without the separators so that they are the same wherever it appears
+            raw = m[match.start() + 1 : end if b is None else b].rstrip()
+            if b is None:
+                raw = raw[:-1]  # closing brace of the file
+            digest = hashlib.blake2b(raw + _CACHE_VERSION, digest_size=16).hexdigest()
+            cache_file = os.path.join(cache_folder, f"{uid}_{digest}.pkl")
+            if os.path.exists(cache_file):
+                with open(cache_file, "rb") as cached:
+                    subjects.append((uid, pkl.load(cached)))
+                os.utime(cache_file)  # mark as used (see _prune_cache)
+                continue
+            # Not cached: decode and check that these bytes really are one complete item
+            items = list(_iter_json_items(path, a, b))
+            if len(items) != 1 or items[0][0] != uid:
+                raise ValueError(f"Failed to locate subject {uid} in {path}.")
+            tabulated = _tabulate_subject(items[0][1])
+            del items
+            # Write atomically in case another process is writing the same subject
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as cached:
+                pkl.dump(tabulated, cached, protocol=pkl.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+            subjects.append((uid, tabulated))
+    return subjects
+
+
 def expand_object_columns(df):
     """
-    Horizontally expand columns that contain Python dictionaries (with multiple values) into separate columns with single values.
+    Horizontally expand columns that contain Python dictionaries (with multiple values) into separate columns with single values.
+    Nested dictionaries are expanded recursively, e.g., {"hand": {"pos": {"x": 0}}} becomes column 'hand_pos_x'.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Unexpanded data frame
+    
+    Returns
+    -------
+    df : DataFrame
+        Horizontally expanded data frame
+    """
+    # Inspect all rows, since the first row may be missing (NaN) or differ in its keys
+    object_columns = [
+        col_name
+        for col_name in df.columns[df.dtypes == object]
+        if any(isinstance(x, dict) for x in df[col_name].to_numpy())
+    ]
+    if len(object_columns) == 0:
+        return df
+    expanded_columns = []
+    for col_name in object_columns:
+        # Nested dictionaries are flattened recursively, non-dictionary values become missing values
+        child_names = [
+            _flatten_dict(x, sep="_") if isinstance(x, dict) else {}
+            for x in df[col_name].to_numpy()
+        ]
+        expanded = pd.DataFrame(child_names, df.index).add_prefix(f"{col_name}_")
+        # Three.js orientation dimensions already have underscores
+        # Don't allow repeated underscores
+        expanded = expanded.rename(columns=lambda x: re.sub("_+", "_", x))
+        expanded_columns.append(expanded)
+        print(f"Expanded {col_name} to {list(expanded.columns)}")
+    df = pd.concat([df.drop(columns=object_columns)] + expanded_columns, axis=1)
+    return df
+
+
+def compact_dtypes(
+    df_trial: pd.DataFrame,
+    df_subject: pd.DataFrame,
+    df_frame: pd.DataFrame,
+    df_state: pd.DataFrame,
+    float32: bool = False,
+):
+    """
+    Reduce the memory used by the data frames returned by `load`:
+    - Non-numeric columns of df_frame and df_state that are constant within every trial (e.g., 'rhOri_isQuaternion') are moved to df_subject if they are also constant within every subject, otherwise to df_trial. Columns that already exist there (e.g., 'cycle') are dropped.
+    - 'subject', 'uid', and other text columns (e.g., 'state') become categorical.
+    - Integer columns (e.g., 'trialNumber' or integer-coded states) are downcast to the smallest integer type.
+    - Optionally, float columns of df_frame and df_state (except 't') are stored as 32-bit floats.
+
+    Parameters
+    ----------
+    df_trial, df_subject, df_frame, df_state : pd.DataFrame
+        Data frames returned by `load`
+    float32 : bool, optional
+        Store float columns of df_frame and df_state as 32-bit floats, by default False
+
+    Returns
+    -------
+    tuple
+        df_trial, df_subject, df_frame, df_state
+    """
+    keys = ["subject", "trialNumber"]
+    for name in ["df_frame", "df_state"]:
+        df = df_frame if name == "df_frame" else df_state
+        if not set(keys) <= set(df.columns) or len(df) == 0:
+            continue
+        starts = _segment_starts(df, keys)
+        subject_starts = _segment_starts(df, ["subject"])
+        # Trials must be contiguous to find their constant values
+        if starts.sum() != len(df[keys].drop_duplicates()):
+            continue
+        moved = []
+        for c in df.columns.drop(keys):
+            values = df[c].to_numpy()
+            # Only flags and labels are moved, so kinematic variables stay in place
+            if c not in df_trial.columns and values.dtype.kind not in "bOU":
+                continue
+            if not _is_constant_within(values, starts):
+                continue
+            if c in df_trial.columns:
+                moved.append(c)  # already in df_trial
+            elif _is_constant_within(values, subject_starts):
+                if c not in df_subject.columns:
+                    df_subject = df_subject.merge(
+                        df.loc[subject_starts, ["subject", c]].drop_duplicates(
+                            "subject"
+                        ),
+                        how="left",
+                        on="subject",
+                    )
+                    moved.append(c)
+            else:
+                df_trial = df_trial.merge(
+                    df.loc[starts, keys + [c]], how="left", on=keys
+                )
+                moved.append(c)
+        if len(moved) > 0:
+            print(f"Moved constant columns from {name}: {moved}")
+            df = df.drop(columns=moved)
+        if name == "df_frame":
+            df_frame = df
+        else:
+            df_state = df
+
+    def compact(df: pd.DataFrame, floats: bool):
+        df = df.copy()
+        for c in df.columns:
+            x = df[c]
+            if pd.api.types.is_bool_dtype(x) or isinstance(
+                x.dtype, pd.CategoricalDtype
+            ):
+                continue
+            elif pd.api.types.is_integer_dtype(x):
+                df[c] = pd.to_numeric(x, downcast="integer")
+            elif pd.api.types.is_float_dtype(x):
+                if floats and c != "t":
+                    df[c] = x.astype(np.float32)
+            elif c in ["subject", "uid"] or (
+                pd.api.types.is_string_dtype(x)
+                and x.map(type, na_action="ignore").isin([str]).all()
+            ):
+                df[c] = x.astype("category")
+        return df
+
+    return (
+        compact(df_trial, False),
+        compact(df_subject, False),
+        compact(df_frame, float32),
+        compact(df_state, float32),
+    )
+
+
+def _apply_dtypes(tables: tuple, dtypes: str, report=None):
+    """
+    Apply a data type policy (see load) to the tables (df_trial, df_subject, df_frame, df_state).
+
+    Raises
+    ------
+    ValueError
+        If the policy is unknown.
+    """
+    if dtypes is None:
+        return tables
+    if dtypes not in {"compact", "compact_float32"}:
+        raise ValueError(f"Unknown dtypes policy '{dtypes}'.")
+    if report is not None:
+        report.start("Compacting data types")
+    return compact_dtypes(*tables, float32=dtypes == "compact_float32")
+
+
+def _segment_starts(df: pd.DataFrame, keys: list):
+    """Boolean array marking the first row of each run of identical values in the `keys` columns."""
+    starts = np.zeros(len(df), dtype=bool)
+    starts[:1] = True
+    for k in keys:
+        x = df[k].to_numpy()
+        starts[1:] |= x[1:] != x[:-1]
+    return starts
+
+
+def _is_constant_within(values: np.ndarray, starts: np.ndarray):
+    """Check whether values are constant within each segment (NaN equals NaN), where `starts` marks the first row of each segment."""
+    a, b = values[1:], values[:-1]
+    same = a == b
+    if values.dtype.kind in "fcO":
+        same |= pd.isna(a) & pd.isna(b)
+    return bool(np.all(same | starts[1:]))
+
+
+def _trial_segments(df: pd.DataFrame, keys: list):
+    """
+    Find contiguous segments of rows with identical `keys` (e.g., trials).
+    If the rows of a segment are not contiguous, also return the stable order that makes them contiguous.
+
+    Returns
+    -------
+    tuple
+        order (None if segments are already contiguous), boolean array marking the first row of each segment (after ordering)
+    """
+    starts = _segment_starts(df, keys)
+    if not df.loc[starts, keys].duplicated().any():
+        return None, starts
+    codes = df.groupby(keys, sort=False, dropna=False, observed=True).ngroup()
+    order = np.argsort(codes.to_numpy(), kind="stable")
+    return order, _segment_starts(df.iloc[order], keys)
+
+
+def _time_segments(df: pd.DataFrame, keys: list, time: str):
+    """Like _trial_segments, but also order the rows of each segment by the `time` column if they are not already."""
+    order, starts = _trial_segments(df, keys)
+    ordered = df if order is None else df.iloc[order]
+    t = ordered[time].to_numpy(dtype=float)
+    if np.all((t[1:] >= t[:-1]) | starts[1:]):
+        return order, starts
+    codes = df.groupby(keys, sort=False, dropna=False, observed=True).ngroup()
+    order = np.lexsort((df[time].to_numpy(dtype=float), codes.to_numpy()))
+    return order, _segment_starts(df.iloc[order], keys)
+
+
+def _segment_diff(x: np.ndarray, starts: np.ndarray):
+    """First difference within segments, NaN at the first row of each segment."""
+    out = np.empty(len(x), dtype=np.result_type(x.dtype, np.float16))
+    out[1:] = x[1:] - x[:-1]
+    out[starts] = np.nan
+    return out
+
+
+def _segment_cumsum(x: np.ndarray, starts: np.ndarray):
+    """Cumulative sum within segments, skipping NaN like pd.Series.cumsum."""
+    isnan = np.isnan(x)
+    out = np.cumsum(np.where(isnan, 0, x))
+    first = np.flatnonzero(starts)
+    offset = np.concatenate([[0], out[first[1:] - 1]]) if len(first) else first
+    out -= np.repeat(offset, np.diff(np.append(first, len(x))))
+    out[isnan] = np.nan
+    return out
+
+
+def _segment_reduce(ufunc: np.ufunc, x: np.ndarray, starts: np.ndarray):
+    """Reduce within segments (e.g., `np.fmin`) and broadcast the result to every row of the segment."""
+    if len(x) == 0:
+        return x.copy()
+    first = np.flatnonzero(starts)
+    return np.repeat(ufunc.reduceat(x, first), np.diff(np.append(first, len(x))))
+
+
+def rename_states(df: pd.DataFrame, df_subject: pd.DataFrame, state_col: str = "state"):
+    """
+    [DEPRECATED] Transform integer-coded state values into categorical strings. Use decode_states instead.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A data frame containing a 'subject' column and a column of integer-coded states.
+    df_subject : pd.DataFrame
+        A subject-level data frame containing a vector of state names.
+        Integer codes correspond to indexes of this vector.
+    state_col : str, optional
+        Name of the column of integer-coded states in `df`, by default "state"
+
+    Returns
+    -------
+    pd.Series
+        A column of categorical state names,.
+    """
+
+    g = df.groupby("subject")[state_col]
+    return g.transform(
+        lambda x: x.replace(
+            df_subject.loc[df_subject["subject"] == x.name, "stateNames"].values[0]
+        ).astype(pd.CategoricalDtype(ordered=True))
+    )
+
+
+def decode_states(df: pd.DataFrame, df_subject: pd.DataFrame, state_col: str = "state"):
+    """
+    Transform integer-coded state values into ordered categorical state names, using each subject's 'stateNames'.
+    The categories are the state names of all subjects in order of first appearance, so states compare in the order of the experiment.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A data frame containing a 'subject' column and a column of integer-coded states (e.g., df_frame or df_state)
+    df_subject : pd.DataFrame
+        Subject-level data frame containing a list of state names ('stateNames'), whose indexes are the integer codes
+    state_col : str, optional
+        Name of the column of integer-coded states in `df`, by default "state" (use "stateChange" for df_state)
+
+    Returns
+    -------
+    pd.Series
+        A column of ordered categorical state names, NaN for codes that are not valid for the subject
+    """
+    categories, subjects, table, offsets, lengths = _state_table(df_subject)
+    dtype = pd.CategoricalDtype(categories, ordered=True)
+    values = df[state_col]
+    if not pd.api.types.is_numeric_dtype(values.dtype):
+        # already names
+        return values.astype(object).astype(dtype)
+    sb = pd.Categorical(df["subject"], categories=subjects).codes.astype(int)
+    code = values.to_numpy(dtype=float)
+    code = np.where(np.isnan(code), -1, code).astype(int)
+    valid = (sb >= 0) & (code >= 0) & (code < np.append(lengths, 0)[sb])
+    codes = np.full(len(df), -1)
+    codes[valid] = table[offsets[sb[valid]] + code[valid]]
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=dtype), index=df.index, name=state_col
+    )
+
+
+def _state_table(df_subject: pd.DataFrame):
+    """
+    Single code table mapping each subject's integer state codes to the categories of all state names.
+
+    Returns
+    -------
+    tuple
+        categories (pd.Index), subjects (pd.Index), category of each code of each subject (concatenated), offset and number of codes of each subject
+    """
+    df_subject = df_subject.drop_duplicates("subject")
+    names = [
+        list(x) if isinstance(x, (list, tuple, np.ndarray)) else []
+        for x in df_subject.get("stateNames", pd.Series([[]] * len(df_subject)))
+    ]
+    flat = pd.Index(list(itertools.chain.from_iterable(names)), dtype=object)
+    categories = pd.Index(pd.unique(flat), dtype=object)
+    lengths = np.array([len(x) for x in names], dtype=int)
+    offsets = np.cumsum(lengths) - lengths
+    subjects = pd.Index(df_subject["subject"].astype(object))
+    return categories, subjects, categories.get_indexer(flat), offsets, lengths
+
+
+def state_visits(
+    df_state: pd.DataFrame,
+    df_subject: pd.DataFrame = None,
+    state_col: str = "stateChange",
+    time_col: str = "stateChangeTime",
+):
+    """
+    Entry time, exit time, and duration of every visit to a state on every trial, from the state changes in df_state.
+    A visit starts at a state change and ends at the next state change of the same trial (NaN for the last visit of a trial).
 
     Parameters
     ----------
-    df : DataFrame
-        Unexpanded data frame
-    
+    df_state : pd.DataFrame
+        Data frame where each row is a state change, with 'subject' and 'trialNumber' columns
+    df_subject : pd.DataFrame, optional
+        Subject-level data frame containing 'stateNames', used to decode states (see decode_states), by default None (keep codes)
+    state_col : str, optional
+        Name of the state column in df_state, by default "stateChange"
+    time_col : str, optional
+        Name of the time column in df_state, by default "stateChangeTime"
+
     Returns
     -------
-    df : DataFrame
-        Horizontally expanded data frame
+    pd.DataFrame
+        One row per visit, ordered by trial and time, with columns 'subject', 'trialNumber', 'visit' (0, 1, ... on each trial), 'state', 'entry', 'exit', and 'duration'
     """
-    object_columns = df.columns[df.iloc[0].apply(isinstance, args=(dict,))].values
-    for col_name in object_columns:
-        child_names = df[col_name].to_list()
-        expanded = pd.DataFrame(child_names, df.index).add_prefix(f"{col_name}_")
-        # Three.js orientation dimensions already have underscores
-        # Don't allow repeated underscores
-        expanded = expanded.rename(columns=lambda x: re.sub("_+", "_", x))
-        df = pd.concat([df, expanded], axis=1)
-        df = df.drop(col_name, axis=1)
-        print(f"Expanded {col_name} to {expanded.columns.values}")
-    return df
+    keys = ["subject", "trialNumber"]
+    codes = df_state.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    order = np.lexsort((df_state[time_col].to_numpy(dtype=float), codes))
+    ordered = df_state.iloc[order]
+    starts = _segment_starts(ordered, keys)
+    first = np.flatnonzero(starts)
+    entry = ordered[time_col].to_numpy(dtype=float)
+    exit = np.append(entry[1:], np.nan)
+    exit[first[1:] - 1] = np.nan
+
+    visits = ordered[keys].reset_index(drop=True)
+    visits["visit"] = np.arange(len(ordered)) - np.repeat(
+        first, np.diff(np.append(first, len(ordered)))
+    )
+    if df_subject is not None:
+        visits["state"] = decode_states(ordered, df_subject, state_col).array
+    else:
+        visits["state"] = ordered[state_col].to_numpy()
+    visits["entry"] = entry
+    visits["exit"] = exit
+    visits["duration"] = exit - entry
+    return visits
 
 
-def rename_states(df: pd.DataFrame, df_subject: pd.DataFrame, state_col: str = "state"):
+def label_frames(df_frame: pd.DataFrame, visits: pd.DataFrame, time_col: str = "t"):
     """
-    [DEPRECATED] Transform integer-coded state values into categorical strings.
+    Label each frame with the state visit it belongs to, i.e. the last state change of its trial at or before the frame.
+    Frames are matched to visits by binary search over the entry times of the visits of their trial.
 
     Parameters
     ----------
-    df : pd.DataFrame
-        A data frame containing a 'subject' column and a column of integer-coded states.
-    df_subject : pd.DataFrame
-        A subject-level data frame containing a vector of state names.
-        Integer codes correspond to indexes of this vector.
-    state_col : str, optional
-        Name of the column of integer-coded states in `df`, by default "state"
+    df_frame : pd.DataFrame
+        Frame-level data frame
+    visits : pd.DataFrame
+        State visits (see state_visits)
+    time_col : str, optional
+        Name of the time column in df_frame, by default "t". Use 't_abs' after compute_kinematics, which makes 't' relative to the start of the trial.
 
     Returns
     -------
-    pd.Series
-        A column of categorical state names,.
+    pd.DataFrame
+        Input df_frame with columns 'visit' (-1 for frames before the first state change of their trial) and 'visit_state' added
     """
-
-    g = df.groupby("subject")[state_col]
-    return g.transform(
-        lambda x: x.replace(
-            df_subject.loc[df_subject["subject"] == x.name, "stateNames"].values[0]
-        ).astype(pd.CategoricalDtype(ordered=True))
-    )
+    keys = ["subject", "trialNumber"]
+    order, starts = _trial_segments(df_frame, keys)
+    frames = df_frame if order is None else df_frame.iloc[order]
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.append(first, len(frames)))
+
+    # Visits are sorted by trial and entry time (see state_visits)
+    v_first = np.flatnonzero(_segment_starts(visits, keys))
+    v_stop = np.append(v_first[1:], len(visits))
+    v_trials = pd.MultiIndex.from_frame(visits.iloc[v_first][keys])
+    trial = v_trials.get_indexer(pd.MultiIndex.from_frame(frames.iloc[first][keys]))
+    lo = np.repeat(np.where(trial >= 0, v_first[trial], 0), lengths)
+    hi = np.repeat(np.where(trial >= 0, v_stop[trial], 0), lengths)
+
+    # Binary search within each trial for the first visit entered after the frame
+    entry = visits["entry"].to_numpy(dtype=float)
+    t = frames[time_col].to_numpy(dtype=float)
+    low, high = lo.copy(), hi.copy()
+    while (low < high).any():
+        mid = (low + high) // 2
+        active = low < high
+        right = active & (entry[np.minimum(mid, len(entry) - 1)] <= t)
+        low = np.where(right, mid + 1, low)
+        high = np.where(active & ~right, mid, high)
+    idx = low - 1
+    found = idx >= lo
+    idx = np.where(found, idx, 0)
+
+    visit = np.where(found, visits["visit"].to_numpy()[idx], -1)
+    state = visits["state"].iloc[idx].reset_index(drop=True).where(found)
+    if order is not None:
+        inverse = np.argsort(order)
+        visit, state = visit[inverse], state.iloc[inverse]
+    df_frame = df_frame.copy()
+    df_frame["visit"] = visit
+    df_frame["visit_state"] = state.array
+    return df_frame
 
 
 def load_demographics(df_subject: pd.DataFrame, path="demographics.csv"):
@@ -294,174 +2281,368 @@ def compute_kinematics(
     RuntimeError
         
     """
-    cols_to_diff = ["t", f"{pos_prefix}_x", f"{pos_prefix}_y", f"{pos_prefix}_z"]
-    g = df_frame.groupby(["subject", "trialNumber"])
-    df_frame[["dt", "dx", "dy", "dz"]] = g[cols_to_diff].diff()
-    df_frame["dpos"] = np.linalg.norm(df_frame[["dx", "dy", "dz"]], axis=1)
+    keys = ["subject", "trialNumber"]
+    order, starts = _trial_segments(df_frame, keys)
+    if order is not None:
+        df_frame = df_frame.iloc[order]
+    t = df_frame["t"].to_numpy(dtype=float)
+    xyz = [df_frame[f"{pos_prefix}_{k}"].to_numpy(dtype=float) for k in "xyz"]
+    dx, dy, dz = [_segment_diff(x, starts) for x in xyz]
+    dpos = np.sqrt(dx * dx + dy * dy + dz * dz)
 
     # eliminate any frames with no movement
-    df_frame = df_frame[
-        df_frame["dpos"] != 0
-    ].copy()  # copy to avoid chained indexing warning
-
-    # REPEAT diff after frame elimination
-    g = df_frame.groupby(["subject", "trialNumber"])
-    df_frame[["dt", "dx", "dy", "dz"]] = g[cols_to_diff].diff()
-    df_frame["dpos"] = np.linalg.norm(df_frame[["dx", "dy", "dz"]], axis=1)
-    df_frame["dpos_xz"] = np.linalg.norm(df_frame[["dx", "dz"]], axis=1)
-    df_frame["cum_distance"] = df_frame.groupby(["subject", "trialNumber"])[
-        "dpos"
-    ].cumsum()
-    df_frame["cum_distance_xz"] = df_frame.groupby(["subject", "trialNumber"])[
-        "dpos_xz"
-    ].cumsum()
-    df_frame["velocity"] = df_frame["dpos"] / (df_frame["dt"] / 1000)
+    # (each dropped frame repeats the previous position, so only dt changes)
+    keep = dpos != 0
+    if not keep.all():
+        df_frame = df_frame[keep]
+        t, starts, dx, dy, dz, dpos = [x[keep] for x in [t, starts, dx, dy, dz, dpos]]
+        xyz = [x[keep] for x in xyz]
+    else:
+        df_frame = df_frame.copy()  # copy to avoid chained indexing warning
+    dt = _segment_diff(t, starts)
+    dpos_xz = np.sqrt(dx * dx + dz * dz)
+    df_frame["dt"] = dt
+    df_frame["dx"] = dx
+    df_frame["dy"] = dy
+    df_frame["dz"] = dz
+    df_frame["dpos"] = dpos
+    df_frame["dpos_xz"] = dpos_xz
+    df_frame["cum_distance"] = _segment_cumsum(dpos, starts)
+    df_frame["cum_distance_xz"] = _segment_cumsum(dpos_xz, starts)
+    df_frame["velocity"] = dpos / (dt / 1000)
 
     # Subtract start time from all trials
-    df_frame = df_frame.join(
-        df_frame.groupby(["subject", "trialNumber"])["t"].min().rename("t_start"),
-        how="left",
-        on=["subject", "trialNumber"],
-    )
+    df_frame["t_start"] = _segment_reduce(np.fmin, t, starts)
     df_frame["t_abs"] = df_frame["t"]
-    df_frame["t"] = df_frame["t"] - df_frame["t_start"]
+    df_frame["t"] = t - df_frame["t_start"].to_numpy()
+
+    # Instantaneous distance from the start (home position) in the XZ-plane
+    # look up each trial's subject once and broadcast it to the frames of the trial
+    home = df_subject.drop_duplicates("subject").set_index("subject")
+    first = np.flatnonzero(starts)
+    idx = home.index.get_indexer(df_frame["subject"].iloc[first])
+    if (idx < 0).any():
+        missing = df_frame["subject"].iloc[first[idx < 0][0]]
+        raise RuntimeError(f"Subject '{missing}' not found in df_subject.")
+    idx = np.repeat(idx, np.diff(np.append(first, len(df_frame))))
+    home_x = home["homePosn.x"].to_numpy(dtype=float)[idx]
+    home_z = home["homePosn.z"].to_numpy(dtype=float)[idx]
+    df_frame["distance"] = np.sqrt(
+        (xyz[0] - home_x) * (xyz[0] - home_x) + (xyz[2] - home_z) * (xyz[2] - home_z)
+    )
+    if order is not None:
+        # restore the original row order
+        df_frame = df_frame.iloc[np.argsort(order[np.flatnonzero(keep)])]
 
-    def distance_from_start(df_frame_subject: pd.DataFrame, dims=[0, 1, 2]):
-        """
-        Instantaneous distance from the start along any dimension (or combination of dimensions).\n
-        Assumes that df_subject exists with columns 'homePosn.x', 'homePosn.y', and 'homePosn.z'.\n
-        Typical usage: `df_frame.groupby("subject", group_keys=False).apply(distance_from_start,dims=[...])`
+    df_frame = df_frame.join(euler_to_direction(data=df_frame, prefix=ori_prefix))
 
-        Parameters
-        ----------
-        df_frame_subject : pd.DataFrame
-            Frame-level data for a single subject.
-        dims : list, optional
-            Array of dimensions along which to compute distance, by default [0, 1, 2] (i.e., 3D Euclidean distance)
+    return df_frame
 
-        Returns
-        -------
-        DataFrame
-            Data frame with a single column containing distance values.
 
-        Raises
-        ------
-        RuntimeError
-            
-        """
+def smooth_kinematics(
+    df_frame: pd.DataFrame,
+    prefixes: list = ["rhPos"],
+    method: str = "savgol",
+    window: int = None,
+    order: int = None,
+    cutoff: float = 10,
+    time: str = "t",
+    names: str = "{prefix}_{quantity}_{dim}",
+    inplace: bool = False,
+    chunk_size: int = 2**14,
+):
+    """
+    Smoothed position, velocity (m/s), and acceleration (m/s^2) of Vector3 variables, for all trials at once.
+    Each frame gets a local polynomial fit to the frames of its trial within a moving window, using the actual frame times, so variable frame intervals are handled exactly.
+    Windows are shifted (not truncated) at the start and end of each trial, and frames with missing values are ignored.
+
+    Typical usage (peak velocity of the smoothed trajectory):
+    ```
+    df_frame = compute_kinematics(df_subject, df_frame)
+    df_frame = smooth_kinematics(df_frame, inplace=True)
+    df_frame["velocity"] = df_frame["rhPos_speed"]
+    df_trial, df_frame = find_first_velocity_peak(df_trial, df_subject, df_frame)
+    ```
 
-        sb = df_frame_subject.name
-        if sb not in df_subject["subject"].unique():
-            raise RuntimeError(
-                f"Subject '{sb}' not found. Apply this function to each subject via groupby('subject')."
-            )
-        xyz = df_frame_subject[
-            [f"{pos_prefix}_x", f"{pos_prefix}_y", f"{pos_prefix}_z"]
-        ]
-        home_xyz = df_subject.loc[
-            df_subject["subject"] == sb, ["homePosn.x", "homePosn.y", "homePosn.z"]
-        ].values.astype(float)
-        xyz = xyz.iloc[:, dims]
-        home_xyz = home_xyz[:, dims]
-        # groupby.apply functions must return DataFrame with same index to preserve shape
-        out = pd.DataFrame(
-            np.linalg.norm(xyz - home_xyz, axis=1), index=df_frame_subject.index
-        )
-        return out
+    Parameters
+    ----------
+    df_frame : pd.DataFrame
+        Frame-level data frame, with columns 'subject', 'trialNumber', `time`, and '<prefix>_x', '<prefix>_y', '<prefix>_z'
+    prefixes : list, optional
+        Names of the Vector3 variables, by default ["rhPos"]
+    method : str, optional
+        "savgol" for a Savitzky-Golay filter (unweighted fit over `window` frames) or "lowpass" for a Gaussian low-pass filter (fit weighted by a Gaussian of time), by default "savgol"
+    window : int, optional
+        Number of frames in each fit, by default None (9 for "savgol", +/- 3 standard deviations of the Gaussian at the median frame interval for "lowpass")
+    order : int, optional
+        Degree of the polynomial, by default None (3 for "savgol", 2 for "lowpass"). Acceleration requires at least 2.
+    cutoff : float, optional
+        Half-power frequency (Hz) of the "lowpass" filter, by default 10
+    time : str, optional
+        Name of the time column (ms), by default "t"
+    names : str, optional
+        Format of the output column names, by default "{prefix}_{quantity}_{dim}", where quantity is "smooth", "vel", or "acc", e.g. 'rhPos_vel_x'.
+        The speed (norm of velocity) is also returned as '<prefix>_speed'.
+    inplace : bool, optional
+        Add the output columns to `df_frame` instead of returning them in a new data frame, by default False
+    chunk_size : int, optional
+        Number of frames processed at a time, by default 2**14 (keeps temporary arrays small)
 
-    df_frame["distance"] = df_frame.groupby("subject", group_keys=False).apply(
-        distance_from_start, dims=[0, 2]
-    )
+    Returns
+    -------
+    pd.DataFrame
+        Output columns with the index of `df_frame` (or `df_frame` itself if `inplace = True`)
 
-    df_frame = df_frame.join(euler_to_direction(data=df_frame, prefix=ori_prefix))
+    Raises
+    ------
+    ValueError
+        If `method` is unknown or `window` is not greater than `order`.
+    """
+    if method not in ["savgol", "lowpass"]:
+        raise ValueError(f"Unknown method '{method}', expected 'savgol' or 'lowpass'.")
+    order = (3 if method == "savgol" else 2) if order is None else order
+    keys = ["subject", "trialNumber"]
+    rows, starts = _time_segments(df_frame, keys, time)
+    frames = df_frame if rows is None else df_frame.iloc[rows]
+    n = len(frames)
+    t = frames[time].to_numpy(dtype=float) / 1000  # s
+    # One contiguous array per input column
+    y = np.array(
+        [frames[f"{p}_{k}"].to_numpy(dtype=float) for p in prefixes for k in "xyz"]
+    ).reshape(-1, n)
+    missing = np.isnan(y).any(axis=0) | np.isnan(t)
+    y[:, missing] = 0
+    t[missing] = 0
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.append(first, n))
+    seg_first = np.repeat(first, lengths)
+    seg_stop = np.repeat(first + lengths, lengths)
+
+    sigma = None
+    if method == "lowpass":
+        # Gaussian whose squared frequency response is 1/2 at `cutoff`
+        sigma = np.sqrt(np.log(2)) / (2 * np.pi * cutoff)
+        if window is None:
+            dt = _segment_diff(t, starts)
+            dt = dt[~np.isnan(dt) & (dt > 0)]
+            half = int(np.ceil(3 * sigma / np.median(dt))) if len(dt) else 1
+            window = 2 * half + 1
+    window = 9 if window is None else window
+    if window <= order:
+        raise ValueError(f"window ({window}) must be greater than order ({order}).")
+
+    # Columns of the output: smoothed position, velocity, acceleration
+    quantities = ["smooth", "vel", "acc"][: min(order, 2) + 1]
+    out = np.full((len(quantities), len(y), n), np.nan)
+    for start in range(0, n, chunk_size):
+        i = slice(start, min(start + chunk_size, n))
+        coef, scale = _local_polyfit(
+            t, y, missing, seg_first[i], seg_stop[i], i, window, order, sigma
+        )
+        for q in range(len(quantities)):
+            # derivatives at u = 0, in units of t (s)
+            out[q, :, i] = coef[q] * (1 if q < 2 else 2) / scale**q
+
+    if rows is not None:
+        # restore the original row order
+        out[:, :, rows] = out.copy()
+    columns, values = [], []
+    for pi, prefix in enumerate(prefixes):
+        for q, quantity in enumerate(quantities):
+            for di, dim in enumerate("xyz"):
+                columns.append(names.format(prefix=prefix, quantity=quantity, dim=dim))
+                values.append(out[q, 3 * pi + di])
+        if order > 0:
+            columns.append(f"{prefix}_speed")
+            values.append(np.linalg.norm(out[1, 3 * pi : 3 * pi + 3], axis=0))
+
+    if inplace:
+        for col, x in zip(columns, values):
+            df_frame[col] = x
+        return df_frame
+    return pd.DataFrame(dict(zip(columns, values)), index=df_frame.index)
+
+
+def _local_polyfit(t, y, missing, first, stop, rows, window, order, sigma=None):
+    """
+    Weighted least-squares polynomial fits of each row of `y` (columns x frames) against time, around each frame of `rows` (slice), within segments [first, stop).
+    Time is scaled within each window to [-1, 1] for a well-conditioned fit.
+    Loops over window offsets and polynomial terms so that all operations are on contiguous arrays of frames.
 
-    return df_frame
+    Returns
+    -------
+    tuple
+        Polynomial coefficients (order + 1, rows of y, frames; NaN if there are too few frames to fit), and the time scale of each window
+    """
+    i = np.arange(rows.start, rows.stop)
+    lo = np.maximum(np.minimum(i - window // 2, stop - window), first)
+    weights, taus = np.zeros((window, len(i))), np.zeros((window, len(i)))
+    idx = np.zeros((window, len(i)), dtype=int)
+    for k in range(window):
+        j = lo + k
+        weights[k] = j < stop
+        idx[k] = np.minimum(j, stop - 1)
+        weights[k, missing[idx[k]]] = 0
+        taus[k] = t[idx[k]] - t[i]
+        if sigma is not None:
+            weights[k] *= np.exp(-0.5 * (taus[k] / sigma) ** 2)
+    scale = np.max(np.abs(taus) * (weights > 0), axis=0)
+    scale[scale == 0] = 1
+
+    # Moments M[k] = sum(w * u**k), and B[k] = sum(w * u**k * y)
+    P = order + 1
+    M = np.zeros((2 * P - 1, len(i)))
+    B = np.zeros((P, len(y), len(i)))
+    yk, wyk = np.empty((len(y), len(i))), np.empty((len(y), len(i)))
+    for k in range(window):
+        u = taus[k] / scale
+        wu = weights[k].copy()
+        for d in range(len(y)):
+            np.take(y[d], idx[k], out=yk[d])
+        for p in range(2 * P - 1):
+            M[p] += wu
+            if p < P:
+                np.multiply(yk, wu, out=wyk)
+                B[p] += wyk
+            wu *= u
+
+    # Solve the normal equations A c = B, where A[k, l] = M[k + l] (symmetric positive definite if fitted)
+    A = [[M[k + l].copy() for l in range(P)] for k in range(P)]
+    bad = ((weights > 0).sum(axis=0) < P) | missing[i]
+    for k in range(P):
+        bad |= ~(A[k][k] > 1e-12 * M[0])  # e.g., repeated frame times
+        pivot = np.where(bad, 1, A[k][k])
+        for r in range(k + 1, P):
+            f = A[r][k] / pivot
+            for c in range(k + 1, P):
+                A[r][c] -= f * A[k][c]
+            B[r] -= f * B[k]
+        A[k][k] = pivot
+    coef = np.empty_like(B)
+    for k in reversed(range(P)):
+        coef[k] = B[k]
+        for c in range(k + 1, P):
+            coef[k] -= A[k][c] * coef[c]
+        coef[k] /= A[k][k]
+    coef[:, :, bad] = np.nan
+    return coef, scale
 
 
 def find_first_velocity_peak(
     df_trial, df_subject, df_frame, dist_range=[0.1, 0.75], pv_thresh=0.05,
 ):
+    """
+    Find the first velocity peak of each trial and the movement onset time preceding it.
+    The peak is searched while distance from home is within `dist_range` of the target distance (or 90% of the maximum distance if the upper bound is never reached).
+    Onset is the last frame before the peak where velocity is at most `pv_thresh` times the peak velocity.
+
+    Parameters
+    ----------
+    df_trial : pd.DataFrame
+        Trial-level data frame
+    df_subject : pd.DataFrame
+        Subject-level data frame containing column 'targetDistance'
+    df_frame : pd.DataFrame
+        Frame-level data frame with 'distance' and 'velocity' columns (see compute_kinematics)
+    dist_range : list, optional
+        Lower and upper bounds of the search window as proportions of target distance, by default [0.1, 0.75]
+    pv_thresh : float, optional
+        Proportion of peak velocity defining movement onset, by default 0.05
+
+    Returns
+    -------
+    tuple
+        df_trial with columns 'pv', 't_pv', and 't_onset_pv' added, and df_frame with columns 't_onset_pv', 't_onset', and 'onset_pv' added
+    """
+    keys = ["subject", "trialNumber"]
+    order, starts = _trial_segments(df_frame, keys)
+    ordered = df_frame if order is None else df_frame.iloc[order]
+    n = len(ordered)
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.append(first, n))
+    pos = np.arange(n)
+    dist = ordered["distance"].to_numpy(dtype=float)
+    vel = ordered["velocity"].to_numpy(dtype=float)
+    t = ordered["t"].to_numpy(dtype=float)
+    result = ordered.iloc[first][keys].reset_index(drop=True)
+
+    def reduce(ufunc, x):
+        return ufunc.reduceat(x, first) if n > 0 else x[:0]
+
+    def first_true(mask):
+        """Index of the first True value in each trial, or the first row of the trial if none."""
+        idx = reduce(np.minimum, np.where(mask, pos, n))
+        return np.where(idx < n, idx, first)
+
+    # This may not work for all experiments!
+    max_dist = reduce(np.fmax, dist)
     if "targetDistance" not in df_subject.columns:
         warnings.warn(
             f"'targetDistance' not found in df_subject... Using maximum distance on each trial instead."
         )
-    # Peak velocity
-    def helper(x):
-        sb = x.name[0]  # x["subject"].values[0]
-        tn = x.name[1]  # x["trialNumber"].values[0]
-
-        # This may not work for all experiments!
-        # try:
-        target_distance = df_subject.query("subject == @sb")["targetDistance"].values[0]
-        # except KeyError as e:
-        #     print(e)
-        #     target_distance = x["distance"].max()
-
-        # Apply peak detection while distance to home is within 10% - 75% (default) of target distance
-        vel_lwr = dist_range[0] * target_distance
-        vel_upr = dist_range[1] * target_distance
-
-        above_vel_lwr = x["distance"] >= vel_lwr
-        # if not any(above_vel_lwr):
-        #     warnings.warn(
-        #         f"\n\t{x.name}: distance never exceeded lower threshold {vel_lwr:.3f}...\n\tThat's a problem! Examine this trial."
-        #     )
-        #     g = sns.lineplot(data=x, x="rhPos_x", y="rhPos_z", sort=False)
-        #     g.set_aspect("equal")
-
-        above_vel_upr = x["distance"] >= vel_upr
-        if not any(above_vel_upr):
-            # warnings.warn(
-            #     f"\n\t{x.name}: distance never exceeded upper threshold {vel_upr:.3f}.\n\tFalling back to 90% of maximum distance = {0.9 * x['distance'].max():.3f}"
-            # )
-            vel_upr = 0.9 * x["distance"].max()  # dist_range[1] * x["distance"].max()
-            above_vel_upr = x["distance"] >= vel_upr
-
-        start_idx = np.argmax(above_vel_lwr)
-        end_idx = np.argmax(above_vel_upr)
-        cropped = x.iloc[start_idx:end_idx]
-
-        try:
-            first_peak_idx = np.argmax(cropped["velocity"])
-        except:
-            print(
-                f"{x.name}: cropped was empty... {vel_lwr, vel_upr, start_idx, end_idx}"
-            )
-            # g = sns.lineplot(data=x, x="rhPos_x", y="rhPos_z", sort=False)
-            # g.set_aspect("equal")
-
-        # get the index of the original data frame
-        pv_idx = cropped.iloc[first_peak_idx].name  # .name because it's a Series
-
-        pv = x.loc[pv_idx, "velocity"]
-        tpv = x.loc[pv_idx, "t"]
-        before_pv = x.loc[:pv_idx]
-        mask = before_pv["velocity"] <= pv_thresh * pv
-        if not any(mask):
-            warnings.warn(
-                f"Pre-peak velocity never below pv_thresh ({pv_thresh*pv:.2} m/s) for {x.name}"
-            )
-            t_onset_pv = before_pv["t"].values[0]
-        else:
-            t_onset_pv = before_pv.loc[mask, "t"].values[-1]
-
-        # Side effects on df_trial
-        sel = (df_trial["subject"] == sb) & (df_trial["trialNumber"] == tn)
-        df_trial.loc[sel, "pv"] = pv
-        df_trial.loc[sel, "t_pv"] = tpv
-        df_trial.loc[sel, "t_onset_pv"] = t_onset_pv
+        target_distance = max_dist
+    else:
+        targets = df_subject.drop_duplicates("subject").set_index("subject")
+        idx = targets.index.get_indexer(result["subject"])
+        if (idx < 0).any():
+            missing = result["subject"][idx < 0].iloc[0]
+            raise RuntimeError(f"Subject '{missing}' not found in df_subject.")
+        target_distance = targets["targetDistance"].to_numpy(dtype=float)[idx]
+
+    # Apply peak detection while distance to home is within 10% - 75% (default) of target distance
+    vel_lwr = dist_range[0] * target_distance
+    vel_upr = dist_range[1] * target_distance
+    above_vel_upr = dist >= np.repeat(vel_upr, lengths)
+    # Fall back to 90% of maximum distance if the upper threshold was never exceeded
+    never_upr = ~reduce(np.logical_or, above_vel_upr)
+    vel_upr = np.where(never_upr, 0.9 * max_dist, vel_upr)
+    above_vel_upr = dist >= np.repeat(vel_upr, lengths)
+    start_idx = first_true(dist >= np.repeat(vel_lwr, lengths))
+    end_idx = first_true(above_vel_upr)
+
+    # First maximum of velocity within the cropped window
+    valid = (
+        (pos >= np.repeat(start_idx, lengths))
+        & (pos < np.repeat(end_idx, lengths))
+        & ~np.isnan(vel)
+    )
+    masked = np.where(valid, vel, -np.inf)
+    peak = valid & (masked == np.repeat(reduce(np.maximum, masked), lengths))
+    pv_idx = reduce(np.minimum, np.where(peak, pos, n))
+    found = pv_idx < n
+    if not found.all():
+        warnings.warn(
+            f"No velocity peak within the distance window for {(~found).sum()} trials, e.g., {tuple(result[~found].iloc[0])}"
+        )
+    pv_idx = np.where(found, pv_idx, 0)
+    pv = np.where(found, vel[pv_idx], np.nan)
+    t_pv = np.where(found, t[pv_idx], np.nan)
 
-        return
+    # Onset is the last frame before the peak where velocity is below threshold
+    below = (vel <= np.repeat(pv_thresh * pv, lengths)) & (
+        pos <= np.repeat(pv_idx, lengths)
+    )
+    onset_idx = reduce(np.maximum, np.where(below, pos, -1))
+    never_below = found & (onset_idx < 0)
+    if never_below.any():
+        warnings.warn(
+            f"Pre-peak velocity never below pv_thresh ({pv_thresh} * peak velocity) for {never_below.sum()} trials, e.g., {tuple(result[never_below].iloc[0])}"
+        )
+    onset_idx = np.where(onset_idx < 0, first, onset_idx)
+    t_onset_pv = np.where(found, t[onset_idx], np.nan)
 
-    # Compute movement onset time based on peak velocity threshold
-    df_frame.groupby(["subject", "trialNumber"]).apply(helper)
+    result["pv"] = pv
+    result["t_pv"] = t_pv
+    result["t_onset_pv"] = t_onset_pv
+    df_trial = df_trial.drop(columns=["pv", "t_pv", "t_onset_pv"], errors="ignore")
+    df_trial = df_trial.merge(result, how="left", on=keys)
 
     # Subtract onset time from all trials
-    df_frame = df_frame.merge(
-        df_trial[["subject", "trialNumber", "t_onset_pv"]],
-        how="left",
-        on=["subject", "trialNumber"],
-    )
+    t_onset_pv = np.repeat(t_onset_pv, lengths)
+    if order is not None:
+        t_onset_pv[order] = t_onset_pv.copy()
+    df_frame = df_frame.reset_index(drop=True)
+    df_frame["t_onset_pv"] = t_onset_pv
     df_frame["t_onset"] = df_frame["t"] - df_frame["t_onset_pv"]
 
     # Identify onset frame
@@ -470,6 +2651,165 @@ def find_first_velocity_peak(
     return df_trial, df_frame
 
 
+def kinematics_pipeline(
+    df_trial: pd.DataFrame,
+    df_subject: pd.DataFrame,
+    df_frame: pd.DataFrame,
+    workers: int = 1,
+    pos_prefix="rhPos",
+    ori_prefix="rhOri",
+    dist_range=[0.1, 0.75],
+    pv_thresh=0.05,
+):
+    """
+    Run compute_kinematics and then find_first_velocity_peak, optionally in parallel with subjects split across processes.
+    Data is passed to the worker processes in shared memory in Arrow format (if pyarrow is installed), rather than pickled.
+
+    Parameters
+    ----------
+    df_trial : pd.DataFrame
+        Trial-level data frame
+    df_subject : pd.DataFrame
+        Subject-level data frame
+    df_frame : pd.DataFrame
+        Frame-level data frame
+    workers : int, optional
+        Number of processes, by default 1. If None, use all CPU cores. The results are the same for any number of workers.
+    pos_prefix, ori_prefix : str, optional
+        See compute_kinematics
+    dist_range, pv_thresh : optional
+        See find_first_velocity_peak
+
+    Returns
+    -------
+    tuple
+        df_trial and df_frame, as returned by find_first_velocity_peak
+    """
+    kwargs = {
+        "pos_prefix": pos_prefix,
+        "ori_prefix": ori_prefix,
+        "dist_range": dist_range,
+        "pv_thresh": pv_thresh,
+    }
+    workers = workers or os.cpu_count()
+    subjects = pd.unique(df_frame["subject"])
+    if workers <= 1 or len(subjects) <= 1:
+        return _kinematics_shard(df_trial, df_subject, df_frame, kwargs)
+
+    # Shards of whole subjects with similar numbers of frames (a few per worker to balance the load)
+    codes = pd.Index(subjects).get_indexer(df_frame["subject"])
+    counts = np.bincount(codes, minlength=len(subjects))
+    nshards = min(len(subjects), 4 * workers)
+    bounds = np.searchsorted(
+        np.cumsum(counts), np.arange(1, nshards) * len(df_frame) / nshards
+    )
+    shard_of_subject = np.searchsorted(
+        np.unique(bounds), np.arange(len(subjects)), "right"
+    )
+    shard_of_frame = shard_of_subject[codes]
+    # Trials of subjects without frames go in the first shard
+    trial_codes = pd.Index(subjects).get_indexer(df_trial["subject"])
+    shard_of_trial = np.where(trial_codes >= 0, shard_of_subject[trial_codes], 0)
+    # Keep track of the original order of rows
+    df_frame = df_frame.assign(_row=np.arange(len(df_frame)))
+    df_trial = df_trial.assign(_row=np.arange(len(df_trial)))
+
+    shared = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for k in range(shard_of_subject.max() + 1):
+                frames = df_frame.iloc[np.flatnonzero(shard_of_frame == k)]
+                frames = _share_frame(frames)
+                if not isinstance(frames, pd.DataFrame):
+                    shared.append(frames[0])
+                    frames = (frames[0].name, frames[1])
+                trials = df_trial.iloc[np.flatnonzero(shard_of_trial == k)]
+                sb = df_subject.loc[
+                    df_subject["subject"].isin(subjects[shard_of_subject == k])
+                ]
+                futures.append(
+                    executor.submit(_kinematics_shard, trials, sb, frames, kwargs, True)
+                )
+            results = [future.result() for future in futures]
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    df_trial = pd.concat([x[0] for x in results], ignore_index=True)
+    df_frame = pd.concat([_unshare_frame(x[1]) for x in results], ignore_index=True)
+    # Reassemble in the original order
+    df_trial = df_trial.iloc[np.argsort(df_trial.pop("_row").to_numpy(), kind="stable")]
+    df_frame = df_frame.iloc[np.argsort(df_frame.pop("_row").to_numpy(), kind="stable")]
+    return df_trial.reset_index(drop=True), df_frame.reset_index(drop=True)
+
+
+def _kinematics_shard(df_trial, df_subject, df_frame, kwargs, worker=False):
+    """Run kinematics_pipeline on a subset of subjects. In worker processes, df_frame is received (and returned) in Arrow format."""
+    shm = None
+    if isinstance(df_frame, tuple):
+        from multiprocessing import shared_memory
+
+        name, size = df_frame
+        shm = shared_memory.SharedMemory(name=name)
+        df_frame = _unshare_frame(shm.buf[:size])
+    df_frame = compute_kinematics(
+        df_subject, df_frame, kwargs["pos_prefix"], kwargs["ori_prefix"]
+    )
+    df_trial, df_frame = find_first_velocity_peak(
+        df_trial, df_subject, df_frame, kwargs["dist_range"], kwargs["pv_thresh"]
+    )
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # still referenced by the data frame; closed when it is deleted
+    if worker:
+        df_frame = _share_frame(df_frame, shared_memory=False)
+    return df_trial, df_frame
+
+
+def _share_frame(df: pd.DataFrame, shared_memory: bool = True):
+    """
+    Serialize a data frame in Arrow IPC format, in a new shared memory block (returns the block and the data size) or in a buffer.
+    Returns the data frame itself if pyarrow is not installed or the data cannot be converted to Arrow.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        return df
+    try:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    except pyarrow.ArrowException:
+        return df
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    buffer = sink.getvalue()
+    if not shared_memory:
+        return buffer
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(create=True, size=max(buffer.size, 1))
+    try:
+        shm.buf[: buffer.size] = memoryview(buffer).cast("B")
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm, buffer.size
+
+
+def _unshare_frame(data):
+    """Read a data frame serialized by _share_frame (or return it if it was not serialized)."""
+    if isinstance(data, pd.DataFrame):
+        return data
+    import pyarrow
+
+    return pyarrow.ipc.open_stream(pyarrow.py_buffer(data)).read_all().to_pandas()
+
+
 def get_nearest_row(df: pd.DataFrame, varname: str, value: float):
     """
     Find row with least difference from specified value of specified column.
@@ -500,29 +2840,25 @@ def euler_to_direction(
         y = euler["_y"]
         z = euler["_z"]
     elif isinstance(data, pd.DataFrame):
-        isEuler = data.get(f"{prefix}_isEuler", pd.Series([False]))
-        isQuaternion = data.get(f"{prefix}_isQuaternion", pd.Series([False]))
-        # print(isQuaternion)
-        if isEuler.all():
-            x = data[f"{prefix}_x"]
-            y = data[f"{prefix}_y"]
-            z = data[f"{prefix}_z"]
-            # (Quaternion/setFromEuler)
-            c1 = np.cos(x / 2)
-            c2 = np.cos(y / 2)
-            c3 = np.cos(z / 2)
-            s1 = np.sin(x / 2)
-            s2 = np.sin(y / 2)
-            s3 = np.sin(z / 2)
-            qx = s1 * c2 * c3 + c1 * s2 * s3
-            qy = c1 * s2 * c3 - s1 * c2 * s3
-            qz = c1 * c2 * s3 + s1 * s2 * c3
-            qw = c1 * c2 * c3 - s1 * s2 * s3
-        elif isQuaternion.all():
-            qw = data[f"{prefix}_w"]
-            qx = data[f"{prefix}_x"]
-            qy = data[f"{prefix}_y"]
-            qz = data[f"{prefix}_z"]
+        # Euler and Quaternion rows are handled by the batched kernel
+        return orientation_directions(
+            data,
+            prefixes=[prefix],
+            axes={"dir": [dir["x"], dir["y"], dir["z"]]},
+            names="{axis}_{dim}",
+        )
+
+    # (Quaternion/setFromEuler)
+    c1 = np.cos(x / 2)
+    c2 = np.cos(y / 2)
+    c3 = np.cos(z / 2)
+    s1 = np.sin(x / 2)
+    s2 = np.sin(y / 2)
+    s3 = np.sin(z / 2)
+    qx = s1 * c2 * c3 + c1 * s2 * s3
+    qy = c1 * s2 * c3 - s1 * c2 * s3
+    qz = c1 * c2 * s3 + s1 * s2 * c3
+    qw = c1 * c2 * c3 - s1 * s2 * s3
 
     # (Vector3/applyQuaternion)
     ix = qw * dir["x"] + qy * dir["z"] - qz * dir["y"]
@@ -535,21 +2871,143 @@ def euler_to_direction(
         "z": iz * qw + iw * -qz + ix * -qy - iy * -qx,
     }
 
-    if isinstance(data, pd.DataFrame):
-        out = pd.DataFrame(out)
-        out = out.rename({"x": "dir_x", "y": "dir_y", "z": "dir_z"}, axis=1)
-
     return out
 
 
+def orientation_directions(
+    df: pd.DataFrame,
+    prefixes: list = ["rhOri"],
+    axes: dict = {"dir": [0, 0, -1]},
+    names: str = "{prefix}_{axis}_{dim}",
+    inplace: bool = False,
+    chunk_size: int = 2**16,
+):
+    """
+    Transform local directions (e.g., the -Z axis) by many orientation variables at once.
+    Each orientation variable may be a Quaternion or an Euler angle (any order), or a mix of both across rows.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame with orientation columns, e.g. 'rhOri_x', 'rhOri_y', 'rhOri_z', 'rhOri_w', and 'rhOri_isQuaternion'.
+        Euler angles are identified by '<prefix>_isEuler' (or by the absence of '<prefix>_w'), with order '<prefix>_order' (default "XYZ").
+    prefixes : list, optional
+        Names of the orientation variables, by default ["rhOri"]
+    axes : dict, optional
+        Local directions (x, y, z) to transform, by name, by default {"dir": [0, 0, -1]}
+    names : str, optional
+        Format of the output column names, by default "{prefix}_{axis}_{dim}", e.g. 'rhOri_dir_x'
+    inplace : bool, optional
+        Add the output columns to `df` instead of returning them in a new data frame, by default False
+    chunk_size : int, optional
+        Number of rows processed at a time, by default 2**16 (keeps temporary arrays small)
+
+    Returns
+    -------
+    pd.DataFrame
+        Output columns with the index of `df` (or `df` itself if `inplace = True`)
+    """
+    n = len(df)
+    columns = [
+        names.format(prefix=prefix, axis=axis, dim=dim)
+        for prefix in prefixes
+        for axis in axes
+        for dim in "xyz"
+    ]
+    # One contiguous array per output column
+    out = np.empty((len(columns), n))
+    directions = np.array(list(axes.values()), dtype=float).reshape(-1, 3)
+    for pi, prefix in enumerate(prefixes):
+        x, y, z = [df[f"{prefix}_{k}"].to_numpy(dtype=float) for k in "xyz"]
+        w = df[f"{prefix}_w"].to_numpy(dtype=float) if f"{prefix}_w" in df else None
+        if f"{prefix}_isEuler" in df:
+            euler = df[f"{prefix}_isEuler"].fillna(False).to_numpy(dtype=bool)
+        elif f"{prefix}_isQuaternion" in df:
+            euler = ~df[f"{prefix}_isQuaternion"].fillna(True).to_numpy(dtype=bool)
+        else:
+            # flags may have been moved out of the frame table (see compact_dtypes)
+            euler = np.full(n, w is None)
+        if w is None:
+            w = np.full(n, np.nan)
+        order = np.zeros(n, dtype=int)
+        if f"{prefix}_order" in df:
+            orders = df[f"{prefix}_order"].to_numpy(dtype=object)
+            order = np.array([_EULER_ORDERS.get(o, 0) for o in orders])
+        for start in range(0, n, chunk_size):
+            rows = slice(start, start + chunk_size)
+            q = _to_quaternion(
+                x[rows], y[rows], z[rows], w[rows], euler[rows], order[rows]
+            )
+            for ai, v in enumerate(directions):
+                col = 3 * (pi * len(directions) + ai)
+                out[col : col + 3, rows] = _apply_quaternion(v, *q)
+
+    if inplace:
+        for col, values in zip(columns, out):
+            df[col] = values
+        return df
+    return pd.DataFrame(dict(zip(columns, out)), index=df.index)
+
+
+# Euler order -> row of _EULER_SIGNS (cf. three.js Quaternion.setFromEuler)
+_EULER_ORDERS = {"XYZ": 0, "YXZ": 1, "ZXY": 2, "ZYX": 3, "YZX": 4, "XZY": 5}
+_EULER_SIGNS = np.array(
+    [
+        [1, -1, 1, -1],
+        [1, -1, -1, 1],
+        [-1, 1, 1, -1],
+        [-1, 1, -1, 1],
+        [1, 1, -1, -1],
+        [-1, -1, 1, 1],
+    ],
+    dtype=float,
+)
+
+
+def _to_quaternion(x, y, z, w, euler, order):
+    """Quaternion (qx, qy, qz, qw) from arrays of Quaternion components, or Euler angles where `euler` is True."""
+    if not euler.any():
+        return x, y, z, w
+    # (Quaternion/setFromEuler)
+    c1 = np.cos(x / 2)
+    c2 = np.cos(y / 2)
+    c3 = np.cos(z / 2)
+    s1 = np.sin(x / 2)
+    s2 = np.sin(y / 2)
+    s3 = np.sin(z / 2)
+    signs = _EULER_SIGNS[order].T
+    qx = s1 * c2 * c3 + signs[0] * (c1 * s2 * s3)
+    qy = c1 * s2 * c3 + signs[1] * (s1 * c2 * s3)
+    qz = c1 * c2 * s3 + signs[2] * (s1 * s2 * c3)
+    qw = c1 * c2 * c3 + signs[3] * (s1 * s2 * s3)
+    if euler.all():
+        return qx, qy, qz, qw
+    return tuple(np.where(euler, a, b) for a, b in zip([qx, qy, qz, qw], [x, y, z, w]))
+
+
+def _apply_quaternion(v, qx, qy, qz, qw):
+    """Rotate vector `v` (x, y, z) by arrays of quaternion components."""
+    # (Vector3/applyQuaternion)
+    ix = qw * v[0] + qy * v[2] - qz * v[1]
+    iy = qw * v[1] + qz * v[0] - qx * v[2]
+    iz = qw * v[2] + qx * v[1] - qy * v[0]
+    iw = -qx * v[0] - qy * v[1] - qz * v[2]
+    return (
+        ix * qw + iw * -qx + iy * -qz - iz * -qy,
+        iy * qw + iw * -qy + iz * -qx - ix * -qz,
+        iz * qw + iw * -qz + ix * -qy - iy * -qx,
+    )
+
+
 def get_trial(df: pd.DataFrame, sb: str = None, tn: str = None):
     """
     Retrieve data for a single trial from a data frame.
 
     Parameters
     ----------
-    df : pd.DataFrame
+    df : pd.DataFrame or TrialIndex
         Data frame containing 'subject' and 'trialNumber' columns.
+        When retrieving many trials from a large data frame, build a TrialIndex once and pass it instead.
     sb : str, optional
         A subject name, by default None chooses a random subject
     tn : str, optional
@@ -557,9 +3015,11 @@ def get_trial(df: pd.DataFrame, sb: str = None, tn: str = None):
 
     Returns
     -------
-    _type_
-        _description_
+    pd.DataFrame
+        Rows of `df` from the requested trial
     """
+    if isinstance(df, TrialIndex):
+        return df.get_trial(sb, tn)
     if sb is None:
         sb = random.choice(df["subject"].unique())
     df = df.loc[df["subject"] == sb]
@@ -569,6 +3029,278 @@ def get_trial(df: pd.DataFrame, sb: str = None, tn: str = None):
     return df
 
 
+class TrialIndex:
+    """
+    Index of the rows belonging to each trial of a data frame (e.g., df_frame or df_state), built once for fast trial lookup and iteration.
+    Rows are sorted (stably) so that each trial occupies a contiguous range, and trials are returned as slices of the sorted data frame without copying.
+
+    Typical usage:
+    ```
+    index = TrialIndex(df_frame)
+    trial = index.get_trial("001", 12)
+    for (sb, tn), trial in index:
+        ...
+    for sb, tn in index.sample(10):
+        ...
+    ```
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame containing 'subject' and 'trialNumber' columns.
+
+    Attributes
+    ----------
+    data : pd.DataFrame
+        `df` with rows grouped by trial (`df` itself if they already were), which can be passed to the other helpers
+    trials : list[tuple]
+        (subject, trialNumber) of each trial in the order of `data`
+    starts, stops : np.ndarray
+        Row range of each trial in `data`
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        order, starts = _trial_segments(df, ["subject", "trialNumber"])
+        self.data = df if order is None else df.iloc[order]
+        self.starts = np.flatnonzero(starts)
+        self.stops = np.append(self.starts[1:], len(df))
+        first = self.data.iloc[self.starts]
+        self.trials = list(
+            zip(first["subject"].tolist(), first["trialNumber"].tolist())
+        )
+        self._rows = {trial: i for i, trial in enumerate(self.trials)}
+        self._subjects = {}
+        for sb, tn in self.trials:
+            self._subjects.setdefault(sb, []).append(tn)
+
+    def __len__(self):
+        return len(self.trials)
+
+    def __contains__(self, trial: tuple):
+        return trial in self._rows
+
+    def __iter__(self):
+        """Iterate over ((subject, trialNumber), rows) of all trials."""
+        for trial, start, stop in zip(self.trials, self.starts, self.stops):
+            yield trial, self.data.iloc[start:stop]
+
+    def subjects(self):
+        """List of subjects, in order of appearance."""
+        return list(self._subjects)
+
+    def trial_numbers(self, sb: str):
+        """List of trial numbers of subject `sb`."""
+        return self._subjects.get(sb, [])
+
+    def get(self, sb: str, tn):
+        """
+        Rows of a single trial.
+
+        Parameters
+        ----------
+        sb : str
+            A subject name
+        tn : int
+            A trial number
+
+        Returns
+        -------
+        pd.DataFrame
+            Rows of the trial (empty if there is no such trial)
+        """
+        i = self._rows.get((sb, tn))
+        if i is None:
+            return self.data.iloc[:0]
+        return self.data.iloc[self.starts[i] : self.stops[i]]
+
+    def get_trial(self, sb: str = None, tn=None):
+        """Same as `get`, but a random subject and/or trial is chosen if `sb` and/or `tn` is None (cf. get_trial)."""
+        if sb is None:
+            sb = random.choice(self.subjects())
+        if tn is None:
+            tn = random.choice(self.trial_numbers(sb))
+        return self.get(sb, tn)
+
+    def sample(self, n: int = 1, sb: str = None):
+        """
+        Random sample of trials without replacement.
+
+        Parameters
+        ----------
+        n : int, optional
+            Number of trials, by default 1
+        sb : str, optional
+            Only sample trials from this subject, by default None (all subjects)
+
+        Returns
+        -------
+        list[tuple]
+            (subject, trialNumber) of the sampled trials, to be used with `get`
+        """
+        if sb is None:
+            return random.sample(self.trials, n)
+        return [(sb, tn) for tn in random.sample(self.trial_numbers(sb), n)]
+
+
+def resample_trials(
+    df_trial: pd.DataFrame,
+    df_frame: pd.DataFrame,
+    variables: list = ["distance"],
+    samples: int = 100,
+    start=None,
+    stop=None,
+    step: float = None,
+    time: str = "t",
+    path: str = None,
+    max_memory: int = 2**30,
+    chunk_size: int = 4096,
+):
+    """
+    Interpolate frame variables of all trials onto a common time grid, giving a dense (subject x trial x sample x variable) array.
+    By default the grid is normalized time: `samples` evenly spaced points from `start` to `stop` of each trial.
+    If `step` is given, the grid is fixed time: `samples` points spaced by `step` from `start`.
+    Interpolation is linear, and grid points outside the recorded frames of a trial are NaN.
+
+    Typical usage (100 points from movement onset to peak velocity):
+    ```
+    df_frame = compute_kinematics(df_subject, df_frame)
+    df_trial, df_frame = find_first_velocity_peak(df_trial, df_subject, df_frame)
+    data, meta = resample_trials(df_trial, df_frame, ["distance", "velocity"], start="t_onset_pv", stop="t_pv")
+    mean_velocity = np.nanmean(data[..., 1], axis=(0, 1))
+    ```
+
+    Parameters
+    ----------
+    df_trial : pd.DataFrame
+        Trial-level data frame, one row per trial of the output array
+    df_frame : pd.DataFrame
+        Frame-level data frame
+    variables : list, optional
+        Names of the frame variables to interpolate, by default ["distance"]
+    samples : int, optional
+        Number of grid points per trial, by default 100
+    start, stop : str or float, optional
+        Start and stop of the grid on each trial, as a column of df_trial (e.g., 't_onset_pv') or a number, in units of `time`.
+        By default None, the first and last frames of each trial. `stop` is ignored if `step` is given.
+    step : float, optional
+        Spacing of a fixed time grid (e.g., 1000 / 90 ms), by default None (normalized time)
+    time : str, optional
+        Name of the time column in df_frame, by default "t"
+    path : str, optional
+        Write the array to this .npy file and return it memory-mapped, by default None. The file belongs to the caller and is kept.
+        Large arrays (more than `max_memory` bytes) are always memory-mapped, to a temporary file if `path` is None,
+        which is deleted when the array and all views of it are garbage-collected (copy or np.save the data to keep it).
+    max_memory : int, optional
+        Size in bytes above which the array is memory-mapped, by default 2**30 (1 GB)
+    chunk_size : int, optional
+        Number of trials interpolated at a time, by default 4096
+
+    Returns
+    -------
+    tuple
+        np.ndarray (or np.memmap) of shape (subjects, max. trials per subject, samples, variables), NaN where a subject has fewer trials,
+        and df_trial with columns 'subject_index' and 'trial_index' (position of the trial in the array), 'grid_start', and 'grid_stop' added
+    """
+    keys = ["subject", "trialNumber"]
+    order, starts = _time_segments(df_frame, keys, time)
+    frames = df_frame if order is None else df_frame.iloc[order]
+    t = frames[time].to_numpy(dtype=float)
+
+    # Position of each trial in the output array
+    meta = df_trial.reset_index(drop=True)
+    subject_index = pd.factorize(meta["subject"])[0]
+    trial_index = meta.groupby("subject", sort=False, observed=True).cumcount()
+    meta["subject_index"] = subject_index
+    meta["trial_index"] = trial_index.to_numpy()
+
+    # Match trials of df_frame to rows of df_trial
+    first = np.flatnonzero(starts)
+    segments = pd.MultiIndex.from_frame(frames.iloc[first][keys])
+    rows = pd.MultiIndex.from_frame(meta[keys]).get_indexer(segments)
+    if (rows < 0).any():
+        warnings.warn(
+            f"{(rows < 0).sum()} trials of df_frame are not in df_trial and were ignored, e.g., {segments[np.argmax(rows < 0)]}"
+        )
+    last = np.append(first[1:], len(t)) - 1
+    # Offset each trial so that times increase across trials, allowing a single binary search
+    offset = np.cumsum(t[last] - t[first] + 1) - (t[last] - t[first] + 1) - t[first]
+    shifted = t + np.repeat(offset, last - first + 1) if len(first) else t
+    kept = rows >= 0
+    first, last, rows, offset = first[kept], last[kept], rows[kept], offset[kept]
+
+    def bound(value, default):
+        if value is None:
+            return default
+        if isinstance(value, str):
+            return meta[value].to_numpy(dtype=float)[rows]
+        return np.full(len(rows), float(value))
+
+    lo = bound(start, t[first])
+    if step is None:
+        hi = bound(stop, t[last])
+        grid = np.linspace(0, 1, samples)
+    else:
+        hi = lo + step * (samples - 1)
+        grid = step * np.arange(samples)
+    meta["grid_start"] = np.nan
+    meta["grid_stop"] = np.nan
+    meta.loc[rows, "grid_start"] = lo
+    meta.loc[rows, "grid_stop"] = hi
+
+    shape = (
+        subject_index.max() + 1 if len(meta) else 0,
+        trial_index.max() + 1 if len(meta) else 0,
+        samples,
+        len(variables),
+    )
+    temporary = path is None and np.prod(shape) * 8 > max_memory
+    if temporary:
+        fd, path = tempfile.mkstemp(prefix="trajectories_", suffix=".npy")
+        os.close(fd)
+        warnings.warn(f"Resampled trials are memory-mapped to {path}")
+    if path is not None:
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=float, shape=shape)
+        if temporary:
+            # delete the file once the array and all views of it are garbage-collected
+            weakref.finalize(out._mmap, _remove_file, path)
+        out[:] = np.nan
+    else:
+        out = np.full(shape, np.nan)
+
+    values = [frames[var].to_numpy(dtype=float) for var in variables]
+    for c in range(0, len(rows), chunk_size):
+        f, l = first[c : c + chunk_size, None], last[c : c + chunk_size, None]
+        if step is None:
+            span = (hi - lo)[c : c + chunk_size, None]
+            tq = lo[c : c + chunk_size, None] + span * grid
+        else:
+            tq = lo[c : c + chunk_size, None] + grid
+        # Frames on either side of each grid point
+        i0 = np.searchsorted(shifted, tq + offset[c : c + chunk_size, None], "right")
+        i0 = np.clip(i0 - 1, f, np.maximum(l - 1, f))
+        i1 = np.minimum(i0 + 1, l)
+        dt = t[i1] - t[i0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w = np.where(dt > 0, (tq - t[i0]) / dt, 0)
+        outside = (tq < t[f]) | (tq > t[l]) | np.isnan(tq)
+        si = subject_index[rows[c : c + chunk_size]]
+        ti = meta["trial_index"].to_numpy()[rows[c : c + chunk_size]]
+        for vi, x in enumerate(values):
+            y = x[i0] + w * (x[i1] - x[i0])
+            y[outside] = np.nan
+            out[si, ti, :, vi] = y
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out, meta
+
+
+def _remove_file(path: str):
+    """Remove a file if it still exists."""
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+
 def MAD(x: list[float]):
     """
     Scaled median absolute deviation (cf. Leys et al 2013)
@@ -603,3 +3335,108 @@ def isoutlier(x: list[float], crit=3):
         Boolean array where true indicates outliers.
     """
     return np.abs(x - np.median(x)) > crit * MAD(x)
+
+
+def grouped_MAD(df: pd.DataFrame, by=None, columns: list = None, skipna=True):
+    """
+    Scaled median absolute deviation (cf. MAD) of several columns within groups, computed for all groups at once.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame containing the grouping and value columns
+    by : str or list, optional
+        Grouping column(s), e.g. "subject" or ["subject", "block"], by default None (a single group)
+    columns : list, optional
+        Numeric columns on which to compute MAD, by default None (all numeric columns not in `by`)
+    skipna : bool, optional
+        Ignore NaN values, by default True. If False, the MAD of a group with any NaN value is NaN (as with MAD).
+
+    Returns
+    -------
+    pd.DataFrame
+        MAD of each column (columns) in each group (index)
+    """
+    by, columns = _grouping(df, by, columns)
+    codes, groups = _group_codes(df, by)
+    mad = {}
+    for col in columns:
+        x = df[col].to_numpy(dtype=float)
+        med = _group_median(x, codes, len(groups), skipna)
+        mad[col] = 1.4826 * _group_median(
+            np.abs(x - med[codes]), codes, len(groups), skipna
+        )
+    return pd.DataFrame(mad, index=groups)
+
+
+def grouped_isoutlier(
+    df: pd.DataFrame, by=None, columns: list = None, crit=3, skipna=True
+):
+    """
+    Outlier detection via MAD threshold (cf. isoutlier) of several columns within groups, computed for all groups at once.
+    Equivalent to `df.groupby(by)[columns].transform(isoutlier)`, but with explicit handling of NaN values.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame containing the grouping and value columns
+    by : str or list, optional
+        Grouping column(s), e.g. "subject" or ["subject", "block"], by default None (a single group)
+    columns : list, optional
+        Numeric columns on which to run outlier detection, by default None (all numeric columns not in `by`)
+    crit : int, optional
+        Criterion threshold, by default 3
+    skipna : bool, optional
+        Ignore NaN values when computing the median and MAD of each group, by default True.
+        If False, no values are flagged in a group with any NaN value (as with isoutlier). NaN values are never flagged.
+
+    Returns
+    -------
+    pd.DataFrame
+        Boolean data frame with the index of `df` and the selected columns, where true indicates outliers
+    """
+    by, columns = _grouping(df, by, columns)
+    codes, groups = _group_codes(df, by)
+    out = {}
+    for col in columns:
+        x = df[col].to_numpy(dtype=float)
+        med = _group_median(x, codes, len(groups), skipna)
+        dev = np.abs(x - med[codes])
+        mad = 1.4826 * _group_median(dev, codes, len(groups), skipna)
+        out[col] = dev > crit * mad[codes]
+    return pd.DataFrame(out, index=df.index)
+
+
+def _grouping(df: pd.DataFrame, by, columns: list):
+    """Grouping columns as a list, and value columns (by default all numeric columns not in `by`)."""
+    by = [] if by is None else [by] if isinstance(by, str) else list(by)
+    if columns is None:
+        columns = [
+            col
+            for col in df.select_dtypes(include=["number", "bool"]).columns
+            if col not in by
+        ]
+    return by, list(columns)
+
+
+def _group_codes(df: pd.DataFrame, by: list):
+    """Group number of each row (in order of first appearance) and the index of groups."""
+    if not by:
+        return np.zeros(len(df), dtype=int), pd.RangeIndex(1)
+    g = df.groupby(by, sort=False, dropna=False, observed=True)
+    return g.ngroup().to_numpy(), g.size().index
+
+
+def _group_median(x: np.ndarray, codes: np.ndarray, ngroups: int, skipna=True):
+    """Median of `x` within each group, by sorting values within groups."""
+    xs = x[np.lexsort((x, codes))]  # NaN values last within groups
+    size = np.bincount(codes, minlength=ngroups)
+    valid = np.bincount(codes, weights=~np.isnan(x), minlength=ngroups).astype(int)
+    first = np.cumsum(size) - size
+    lo = np.clip(first + (valid - 1) // 2, 0, max(len(x) - 1, 0))
+    hi = np.clip(first + valid // 2, 0, max(len(x) - 1, 0))
+    med = (xs[lo] + xs[hi]) / 2 if len(x) else np.full(ngroups, np.nan)
+    med[valid == 0] = np.nan
+    if not skipna:
+        med[valid < size] = np.nan
+    return med
@@ -0,0 +1,278 @@
+"""
+Persistent local worker that keeps a Python interpreter (with pandas and numpy imported) and recently wrangled tables in memory between calls of wrangle.py.
+Use `python wrangle.py ... --worker` (or `ouvrai wrangle --worker`) to send the work to the worker, which is started if it is not running.
+The worker exits after being idle for a while, or when stopped with `python -m ouvrai.worker --stop`.
+"""
+
+import os, sys, io, re, json, time, secrets, threading, traceback, subprocess, warnings
+import contextlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# Address and key of the running worker (readable only by the user)
+STATE_FILE = os.path.join(os.path.expanduser("~"), ".ouvrai_worker.json")
+
+
+def serve(idle: float = 1800, keep: int = 2):
+    """
+    Run the worker until it is stopped or idle for `idle` seconds.
+
+    Parameters
+    ----------
+    idle : float, optional
+        Seconds without requests after which the worker exits, by default 1800
+    keep : int, optional
+        Number of most recently wrangled studies whose tables are kept in memory, by default 2
+    """
+    import ouvrai as ou
+
+    ou.load  # import pandas and numpy now rather than on the first request
+    authkey = secrets.token_bytes(32)
+    with Listener(("localhost", 0), authkey=authkey) as listener:
+        _write_state(
+            {"port": listener.address[1], "authkey": authkey.hex(), "pid": os.getpid()}
+        )
+        last_request = [time.monotonic()]
+        busy = threading.Event()  # set while a request is handled
+
+        def watchdog():
+            while busy.is_set() or time.monotonic() - last_request[0] < idle:
+                time.sleep(min(idle, 10))
+            _remove_state()
+            os._exit(0)
+
+        threading.Thread(target=watchdog, daemon=True).start()
+        recent = {}
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                continue  # e.g., wrong authkey
+            with conn:
+                busy.set()
+                last_request[0] = time.monotonic()
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    busy.clear()
+                    continue
+                if request.get("command") == "stop":
+                    conn.send(("done", None))
+                    break
+                try:
+                    _handle_load(request["kwargs"], conn, recent, keep)
+                    conn.send(("done", None))
+                except Exception:
+                    with contextlib.suppress(OSError):
+                        conn.send(("error", traceback.format_exc()))
+                last_request[0] = time.monotonic()
+                busy.clear()
+    _remove_state()
+
+
+def _handle_load(kwargs: dict, conn, recent: dict, keep: int):
+    """Run `load(**kwargs)` in the worker, forwarding output to the client, and reusing tables if the data files have not changed."""
+    from . import ouvrai as ou
+
+    def progress(text):
+        conn.send(("progress", text))
+
+    stdout, stderr = _Forward(conn, "stdout"), _Forward(conn, "stderr")
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        with warnings.catch_warnings():
+            warnings.simplefilter("default")
+            kwargs = dict(kwargs)
+            data_folder = kwargs["data_folder"]  # absolute (see load)
+            file_regex = kwargs.get("file_regex", "^data_")
+            key = (
+                data_folder,
+                file_regex,
+                kwargs.get("dtypes"),
+            )
+            files = _file_stats(data_folder, file_regex)
+            report = ou.LoadReport(progress)
+            if key in recent and recent[key]["files"] == files:
+                # Same data files as last time: only save the tables again
+                print("Data files are unchanged since the last call, reusing tables")
+                tables, schema = recent[key]["tables"], recent[key]["schema"]
+            else:
+                recent.pop(key, None)
+                *tables, schema = ou._wrangle(
+                    data_folder,
+                    file_regex,
+                    kwargs.get("workers", 1),
+                    kwargs.get("cache", False),
+                    kwargs.get("dtypes"),
+                    report,
+                )
+                tables = dict(zip(["trial", "subject", "frame", "state"], tables))
+            save_format = kwargs.get("save_format", "pkl")
+            ou._save_outputs(
+                tables,
+                schema,
+                data_folder,
+                kwargs.get("save_name", "df"),
+                "pkl" if kwargs.get("pickle") else save_format,
+                kwargs.get("frame_format"),
+                report,
+            )
+            tables["frame"].reset_index(drop=True, inplace=True)
+            report.finish(*tables.values())
+            if kwargs.get("profile"):
+                print(report)
+            # Most recent studies last
+            recent[key] = {"files": files, "tables": tables, "schema": schema}
+            while len(recent) > keep:
+                recent.pop(next(iter(recent)))
+        stdout.flush()
+        stderr.flush()
+
+
+def _file_stats(data_folder: str, file_regex: str):
+    """Name, size, and modification time of the data files."""
+    return sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(data_folder)
+        if entry.is_file() and re.search(file_regex, entry.name)
+    )
+
+
+class _Forward(io.TextIOBase):
+    """Text stream that sends complete lines to the client."""
+
+    def __init__(self, conn, name: str):
+        self.conn = conn
+        self.name = name
+        self.buffer = ""
+
+    def write(self, text: str):
+        self.buffer += text
+        if "\n" in self.buffer:
+            lines, self.buffer = self.buffer.rsplit("\n", 1)
+            self.conn.send((self.name, lines + "\n"))
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.conn.send((self.name, self.buffer))
+            self.buffer = ""
+
+
+def load(progress=None, timeout: float = 60, **kwargs):
+    """
+    Run `ouvrai.load(**kwargs)` in the worker (started if it is not running), printing its output here.
+    The data frames stay in the worker and are not returned.
+
+    Parameters
+    ----------
+    progress : function, optional
+        Called with a short description of the current stage (see load), by default None (printed)
+    timeout : float, optional
+        Seconds to wait for a new worker to start, by default 60
+
+    Raises
+    ------
+    RuntimeError
+        If the worker could not be started, died during the request, or load failed in the worker (with the traceback of the worker).
+    """
+    # The worker may have been started in another directory, so send an absolute path
+    data_folder = kwargs.get("data_folder", "./").lstrip("'").rstrip("'")
+    kwargs["data_folder"] = os.path.join(os.path.abspath(data_folder), "")
+    conn = _connect() or _start(timeout)
+    with conn:
+        try:
+            conn.send({"command": "load", "kwargs": kwargs})
+            while True:
+                kind, value = conn.recv()
+                if kind == "done":
+                    return
+                elif kind == "error":
+                    raise RuntimeError(
+                        f"Failed to wrangle data in the worker:\n{value}"
+                    )
+                elif kind == "progress":
+                    (progress or print)(value)
+                else:
+                    getattr(sys, kind).write(value)
+                    getattr(sys, kind).flush()
+        except (EOFError, ConnectionError) as e:
+            raise RuntimeError(
+                "The Ouvrai worker died while wrangling data. Run again without --worker to wrangle in this process."
+            ) from e
+
+
+def stop():
+    """Stop the worker, if it is running."""
+    conn = _connect()
+    if conn is not None:
+        with conn:
+            conn.send({"command": "stop"})
+            with contextlib.suppress(EOFError):
+                conn.recv()
+
+
+def _connect():
+    """Connection to the running worker, or None."""
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+        return Client(
+            ("localhost", state["port"]), authkey=bytes.fromhex(state["authkey"])
+        )
+    except (OSError, ValueError, KeyError, EOFError, AuthenticationError):
+        return None
+
+
+def _start(timeout: float):
+    """Start a worker in the background and connect to it."""
+    _remove_state()
+    options = {}
+    if sys.platform == "win32":
+        options["creationflags"] = subprocess.DETACHED_PROCESS
+    else:
+        options["start_new_session"] = True
+    subprocess.Popen(
+        [sys.executable, "-m", "ouvrai.worker"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        **options,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = _connect()
+        if conn is not None:
+            return conn
+        time.sleep(0.1)
+    raise RuntimeError("Failed to start the Ouvrai worker.")
+
+
+def _write_state(state: dict):
+    """Write the state file atomically, readable only by the user."""
+    tmp = f"{STATE_FILE}.{os.getpid()}.tmp"
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, STATE_FILE)
+
+
+def _remove_state():
+    """Remove the state file if it belongs to this process (or to no running worker)."""
+    with contextlib.suppress(OSError, ValueError):
+        with open(STATE_FILE) as f:
+            pid = json.load(f).get("pid")
+        if pid == os.getpid() or _connect() is None:
+            os.remove(STATE_FILE)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ouvrai worker process.")
+    parser.add_argument("--idle", type=float, default=1800)
+    parser.add_argument("--keep", type=int, default=2)
+    parser.add_argument("--stop", action="store_true", help="Stop the worker")
+    args = parser.parse_args()
+    if args.stop:
+        stop()
+    else:
+        serve(idle=args.idle, keep=args.keep)
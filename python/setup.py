@@ -1,5 +1,8 @@
 from setuptools import setup
 
 setup(
-    name="ouvrai", packages=["ouvrai"], install_requires=["pandas", "openpyxl",],
+    name="ouvrai",
+    packages=["ouvrai"],
+    install_requires=["pandas", "openpyxl",],
+    extras_require={"parquet": ["pyarrow"]},
 )
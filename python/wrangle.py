@@ -1,16 +1,85 @@
 import ouvrai as ou
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument("data_folder")
-parser.add_argument("save_format")
-parser.add_argument("file_regex", default="^data_.*\.json$")
-parser.add_argument("save_filename", default="df")
-args = parser.parse_args()
+# Guard is required for worker processes when the start method is 'spawn' (Windows, macOS)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_folder")
+    parser.add_argument("save_format")
+    parser.add_argument("file_regex", default="^data_.*\.json$")
+    parser.add_argument("save_filename", default="df")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-c", "--cache", action="store_true")
+    parser.add_argument("-d", "--dtypes", choices=["compact", "compact_float32"])
+    parser.add_argument("-p", "--profile", action="store_true")
+    # e.g., save the frame table to Parquet when other tables are saved to Excel
+    parser.add_argument("--frame-format")
+    # Keep wrangling new data files until interrupted (see ouvrai.watch)
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=float, default=10)
+    # Combine several studies, saving them in data_folder (see ouvrai.load_studies)
+    parser.add_argument("--studies", nargs="+")
+    # Run in a persistent worker process that keeps recent tables in memory (see ouvrai.worker)
+    parser.add_argument("--worker", action="store_true")
+    # Print progress as lines starting with "PROGRESS " (read by ouvrai-wrangle.js)
+    parser.add_argument("--progress", action="store_true")
+    args = parser.parse_args()
 
-df, df_sub, df_frame, df_state = ou.load(
-    data_folder=args.data_folder,
-    file_regex=args.file_regex,
-    save_format=args.save_format,
-    save_name=args.save_filename,
-)
+    def progress(text):
+        print(f"PROGRESS {text}", flush=True)
+
+    if args.watch:
+        ou.watch(
+            data_folder=args.data_folder,
+            file_regex=args.file_regex,
+            save_format=args.save_format,
+            save_name=args.save_filename,
+            interval=args.interval,
+            workers=args.workers,
+            dtypes=args.dtypes,
+            progress=progress if args.progress else None,
+            frame_format=args.frame_format,
+        )
+    elif args.studies:
+        outputs = ou.load_studies(
+            args.studies,
+            file_regex=args.file_regex,
+            save_folder=args.data_folder,
+            save_format=args.save_format,
+            save_name=args.save_filename,
+            workers=args.workers,
+            cache=args.cache,
+            dtypes=args.dtypes,
+            profile=args.profile,
+            progress=progress if args.progress else None,
+        )
+        if args.profile:
+            print(outputs[-1])
+    elif args.worker:
+        ou.worker.load(
+            data_folder=args.data_folder,
+            file_regex=args.file_regex,
+            save_format=args.save_format,
+            save_name=args.save_filename,
+            workers=args.workers,
+            cache=args.cache,
+            dtypes=args.dtypes,
+            profile=args.profile,
+            progress=progress if args.progress else None,
+            frame_format=args.frame_format,
+        )
+    else:
+        outputs = ou.load(
+            data_folder=args.data_folder,
+            file_regex=args.file_regex,
+            save_format=args.save_format,
+            save_name=args.save_filename,
+            workers=args.workers,
+            cache=args.cache,
+            dtypes=args.dtypes,
+            profile=args.profile,
+            progress=progress if args.progress else None,
+            frame_format=args.frame_format,
+        )
+        if args.profile:
+            print(outputs[-1])